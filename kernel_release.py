@@ -27,8 +27,9 @@ import glob
 
 from lib.json_parser import JSONParser
 from lib.decorators import format_h1
-from lib.pyshell import GitShell, PyShell
+from lib.pyshell import GitShell, PyShell, push_refs
 from lib.build_kernel import is_valid_kernel
+from lib.quilt_export import QuiltExporter
 
 class KernelRelease(object):
 
@@ -120,13 +121,14 @@ class KernelRelease(object):
 
         src = os.path.abspath(src)
         dest_dir = src
-        used_temp = False
+        temp_dirs = []
+        # (dest dir, remote name) -> [GitShell, refspecs], each one uploaded with a single push.
+        pushes = {}
 
         try:
             for cfg in remote_cfg:
 
                 dest_dir = src
-                used_temp = False
 
                 if len(cfg["remote"]) > 0 and cfg["remote"] is not None and cfg["remote"][1] is not None:
                     remote_list = [cfg["remote"]]
@@ -149,8 +151,8 @@ class KernelRelease(object):
                         else:
                             dest_dir = os.path.abspath(cfg["destdir"])
                     else:
-                        used_temp = True
                         dest_dir = tempfile.mkdtemp()
+                        temp_dirs.append(dest_dir)
 
                     git = GitShell(wd=dest_dir, init=True, remote_list=remote_list, fetch_all=True, logger=self.logger)
 
@@ -164,7 +166,7 @@ class KernelRelease(object):
 
                     # If clean update is True, then remove all contents of the repo.
                     if cfg["clean_update"] is True:
-                        ret = git.cmd('rm', cfg["remotedir"] + '/*' if cfg["remotedir"] != '.' else '*')[0]
+                        ret = git.cmd('rm', cfg["remotedir"] + '/*' if cfg["remotedir"] != '.' else '*', shell=True)[0]
                         if ret != 0:
                             Exception("git rm -r *.patch failed")
 
@@ -182,16 +184,20 @@ class KernelRelease(object):
                         if ret != 0:
                             Exception("git add %s failed", cfg["remotedir"] + '/' + os.path.basename(item))
 
-                    ret = git.cmd('commit -s -m "' + cfg["commit_msg"] + '"')[0]
+                    ret = git.cmd('commit', '-s', '-m', cfg["commit_msg"])[0]
                     if ret != 0:
                         Exception("git commit failed")
 
                 git = GitShell(wd=dest_dir, init=True, remote_list=remote_list, fetch_all=True, logger=self.logger)
 
-                ret = git.push('HEAD', cfg["remote"][0], rbranch, force=cfg["force_update"],
-                               use_refs=cfg["use_refs"])[0]
-                if ret != 0:
-                        Exception("git push to %s %s failed" % (cfg["remote"][0], rbranch))
+                # HEAD may move before the push (next config using the same dir), so push its SHA.
+                if cfg["use_refs"] is True:
+                    rbranch = 'refs/for/' + rbranch
+                elif not rbranch.startswith('refs/'):
+                    rbranch = 'refs/heads/' + rbranch
+                refspec = git.rev_parse('HEAD') + ':' + rbranch
+                push = pushes.setdefault((dest_dir, cfg["remote"][0]), [git, []])
+                push[1].append('+' + refspec if cfg["force_update"] is True else refspec)
 
                 for tag in cfg["tag_list"]:
                     # Push the tags if required
@@ -203,12 +209,28 @@ class KernelRelease(object):
                         if ret != 0:
                             Exception("git tag %s failed" % (tag[0]))
 
-                        ret = git.cmd('push', cfg["remote"][0], tag[0])[0]
-                        if ret != 0:
-                            Exception("git push tag to %s failed" % (cfg["remote"][0]))
+                        push[1].append('refs/tags/' + tag[0])
+
+            # Branch and tags of each remote are pushed at once, different remotes are pushed concurrently.
+            keys = pushes.keys()
+            results = push_refs([(pushes[key][0], key[1], pushes[key][1]) for key in keys], logger=self.logger)
+
+            failed = []
+            for (dest_dir, remote), (ret, refs, err) in zip(keys, results):
+                for src_ref, dst_ref, flag, summary in refs:
+                    self.logger.info("%s %s -> %s: %s" % (remote, src_ref, dst_ref, summary))
+                    if flag == '!':
+                        failed.append(remote + ' ' + dst_ref)
+                if ret != 0 and len(refs) == 0:
+                    self.logger.error(err)
+                    failed.append(remote)
+
+            if len(failed) > 0:
+                raise Exception("git push failed: %s" % ', '.join(failed))
+
         except Exception as e:
             self.logger.error(e)
-            if used_temp is True:
+            for dest_dir in temp_dirs:
                 shutil.rmtree(dest_dir)
             return False
         else:
@@ -217,13 +239,12 @@ class KernelRelease(object):
     def generate_quilt(self, local_branch=None, base=None, head=None,
                        patch_dir='quilt',
                        sed_file=None,
-                       series_comment=''):
+                       series_comment='',
+                       jobs=None):
 
 
         set_val = lambda x, y: y if x is None else x
 
-        clean_bkup = False
-
         self.logger.info(format_h1("Generating quilt series", tab=2))
 
         if not self.valid_git:
@@ -243,14 +264,6 @@ class KernelRelease(object):
 
         try:
             patch_dir = os.path.abspath(patch_dir)
-            patch_dir_bkup = patch_dir + '.old'
-            if os.path.exists(patch_dir):
-                clean_bkup = True
-                shutil.move(patch_dir, patch_dir_bkup)
-
-            os.makedirs(patch_dir)
-
-            series_file = os.path.join(patch_dir, 'series')
 
             # if base SHA is not given use TAIL as base SHA
             if base is None:
@@ -264,32 +277,14 @@ class KernelRelease(object):
                 if head is None:
                     raise Exception("git fetch head SHA failed")
 
-            ret, out, err = self.git.cmd('format-patch', '-C', '-M', base.strip() + '..' + head.strip(), '-o',
-                                         patch_dir)
-            if ret != 0:
-                raise Exception("git format patch command failed out: %s error: %s" % (out, err))
-
-            if sed_file is not None:
-                ret, out, err = self.sh.cmd('sed -i -f%s %s/*.patch' % (sed_file, patch_dir), shell=True)
-                if ret != 0:
-                    raise Exception("sed command failed %s" % err)
-
-            with open(series_file, 'w+') as fobj:
-                fobj.write(series_comment)
-            ret, out, err = self.sh.cmd('ls -1 *.patch >> series', wd=patch_dir, shell=True)
-            if ret != 0:
-                raise Exception("Writing to patch series file failed. Error: %s" % err)
+            # Patches of the previous series are re-used, series file is replaced atomically at the end.
+            QuiltExporter(self.git, patch_dir, jobs=jobs, sed_file=sed_file,
+                          logger=self.logger).export(base, head, series_comment)
 
         except Exception as e:
-            if os.path.exists(patch_dir):
-                shutil.rmtree(patch_dir)
-            if clean_bkup is True:
-                    shutil.move(patch_dir_bkup, patch_dir)
             self.logger.error(e)
             return None
         else:
-            if clean_bkup is True:
-                shutil.rmtree(patch_dir_bkup)
             return patch_dir
 
 
@@ -26,7 +26,8 @@ import re
 from lib.json_parser import JSONParser
 from lib.build_kernel import BuildKernel, is_valid_kernel
 from lib.decorators import format_h1
-from lib.pyshell import PyShell, GitShell
+from lib.pyshell import PyShell, GitShell, CmdLoop
+from lib.cmd_replay import CmdTranscript, set_transcript
 
 RESULT_SCHEMA = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'schema/kernel-test-results-schema.json')
 TEST_SCHEMA = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'schema/kernel-test-schema.json')
@@ -235,7 +236,7 @@ class KernelResults(object):
 
 class KernelTest(object):
 
-    def __init__(self, src, out=None, branch=None, head=None, base=None, res_cfg=None, logger=None):
+    def __init__(self, src, out=None, branch=None, head=None, base=None, res_cfg=None, jobs=None, logger=None):
         self.logger = logger or logging.getLogger(__name__)
         self.src = src
         self.out = os.path.join(self.src, 'out') if out is None else os.path.absapth(out)
@@ -247,6 +248,8 @@ class KernelTest(object):
         self.resobj = KernelResults(self.src, old_cfg=res_cfg, logger=self.logger)
         self.git = GitShell(wd=self.src, logger=logger)
         self.sh = PyShell(wd=self.src, logger=logger)
+        # Used to run independent commands (like per patch checkpatch runs) concurrently.
+        self.loop = CmdLoop(max_jobs=jobs, logger=self.logger)
         self.checkpatch_source = CHECK_PATCH_SCRIPT
         self.aiaiai_source = ""
 
@@ -328,6 +331,28 @@ class KernelTest(object):
 
         return status
 
+    def _count_issues(self, out, err):
+        """
+        Count the warning and error lines in the build output, and close both output spools.
+        :param out: OutputSpool object with the build output.
+        :param err: OutputSpool object with the build error output.
+        :return: Tuple of warning count and error count.
+        """
+        warning_count = 0
+        error_count = 0
+
+        try:
+            for line in out.lines():
+                if "warning:" in line:
+                    warning_count += 1
+                if "error:" in line:
+                    error_count += 1
+        finally:
+            out.close()
+            err.close()
+
+        return warning_count, error_count
+
     def compile(self, arch='', config='', cc='', cflags=[]):
         if arch not in supported_archs or config not in supported_configs:
             self.logger.error("Invalid arch/config %s/%s" % (arch, config))
@@ -337,10 +362,9 @@ class KernelTest(object):
                            arch=arch, cc=cc, cflags=cflags, logger=self.logger)
         getattr(kobj, 'make_' + config)()
 
-        ret, out, err = kobj.make_kernel()
+        ret, out, err = kobj.make_kernel(spool=True)
 
-        warning_count =len(filter(lambda x: True if "warning:" in x else False, out.split('\n')))
-        error_count = len(filter(lambda x: True if "error:" in x else False, out.split('\n')))
+        warning_count, error_count = self._count_issues(out, err)
 
         status = True if ret == 0 else False
 
@@ -360,10 +384,9 @@ class KernelTest(object):
                            arch=arch, cc=cc, cflags=sparse_flags + cflags, logger=self.logger)
         getattr(kobj, 'make_' + config)()
 
-        ret, out, err = kobj.make_kernel()
+        ret, out, err = kobj.make_kernel(spool=True)
 
-        warning_count =len(filter(lambda x: True if "warning:" in x else False, out.split('\n')))
-        error_count = len(filter(lambda x: True if "error:" in x else False, out.split('\n')))
+        warning_count, error_count = self._count_issues(out, err)
 
         status = True if ret == 0 else False
 
@@ -383,10 +406,9 @@ class KernelTest(object):
                            arch=arch, cc=cc, cflags=sparse_flags + cflags, logger=self.logger)
         getattr(kobj, 'make_' + config)()
 
-        ret, out, err = kobj.make_kernel()
+        ret, out, err = kobj.make_kernel(spool=True)
 
-        warning_count =len(filter(lambda x: True if "warning:" in x else False, out.split('\n')))
-        error_count = len(filter(lambda x: True if "error:" in x else False, out.split('\n')))
+        warning_count, error_count = self._count_issues(out, err)
 
         status = True if ret == 0 else False
 
@@ -464,17 +486,21 @@ class KernelTest(object):
 
                 return 0, 0
 
+            futures = []
             prev_index = 0
             for index in range(1, int(count) + 1):
                 commit_range = str(self.head) + '~' + str(index) + '..' + str(self.head) + '~' + str(prev_index)
-                ret, out, err = self.sh.cmd(os.path.join(self.src, CHECK_PATCH_SCRIPT), '-g', commit_range)
+                futures.append(self.sh.cmd_async(os.path.join(self.src, CHECK_PATCH_SCRIPT), '-g', commit_range,
+                                                 loop=self.loop))
+                prev_index = index
+
+            for ret, out, err in self.loop.gather(*futures):
                 error, warning = parse_results(out)
                 if error != 0 or warning != 0:
                     self.logger.debug(out)
                     self.logger.debug(err)
                 err_count += error
                 warning_count += warning
-                prev_index = index
         except Exception as e:
             self.logger.error(e)
             return False, err_count, warning_count
@@ -573,6 +599,18 @@ def add_cli_options(parser):
                         nargs='?',
                         const=os.path.join(os.getcwd(), 'ktest.log'),
                         help='Kernel test log file')
+    parser.add_argument('-j', '--jobs', action='store', type=int, dest='jobs',
+                        default=None,
+                        help='Max number of test commands to run in parallel (default: cpu count)')
+    parser.add_argument('--record', action='store', dest='record',
+                        default=None,
+                        help='Record all executed commands and their results in given transcript file')
+    parser.add_argument('--replay', action='store', dest='replay',
+                        default=None,
+                        help='Do not execute any command, serve the results from given transcript file')
+    parser.add_argument('--replay-delay', action='store_true', dest='replay_delay',
+                        default=False,
+                        help='Sleep for the recorded duration of each replayed command')
     parser.add_argument('-d', '--debug', action='store_true', dest='debug',
                         help='Enable debug option')
 
@@ -598,12 +636,18 @@ if __name__ == "__main__":
     if args.debug:
             logger.setLevel(logging.DEBUG)
 
+    if args.record is not None:
+        set_transcript(CmdTranscript(args.record, 'record', root=args.source_dir, logger=logger))
+    elif args.replay is not None:
+        set_transcript(CmdTranscript(args.replay, 'replay', root=args.source_dir, delay=args.replay_delay,
+                                     logger=logger))
+
     print args
 
     obj= None
 
     obj = KernelTest(src=args.source_dir, base=args.base, head=args.head, branch=args.branch, res_cfg=args.out_json,
-                     logger=logger)
+                     jobs=args.jobs, logger=logger)
 
     if obj:
         if args.which == 'use_compile':
@@ -17,6 +17,13 @@
 #
 
 import os
+import re
+import sys
+import json
+import time
+import threading
+import fnmatch
+import fcntl
 import logging, logging.config
 import argparse
 import yaml
@@ -26,7 +33,14 @@ from lib.json_parser import JSONParser
 from lib.build_kernel import BuildKernel
 from lib.decorators import format_h1
 from lib.rand_utils import git_send_email
-from lib.pyshell import GitShell, PyShell
+from lib.pyshell import GitShell, PyShell, CmdLoop, get_cancel_token, set_cmd_timeout, push_refs
+from lib.dep_graph import DepGraph
+from lib.integ_cache import IntegCache
+from lib.rr_cache import RRCacheSync, get_backend, DEFAULT_MAX_AGE_DAYS
+from lib.quilt_export import QuiltExporter
+from lib.run_journal import RunJournal
+from lib.cmd_trace import get_tracer
+from lib.cmd_replay import CmdTranscript, set_transcript, get_transcript
 
 
 GIT_COMMAND_PATH='/usr/bin/git'
@@ -35,6 +49,118 @@ set_val = lambda k, v: v if k is None else k
 
 set_list_val = lambda k, v: k if len(k) > 0 else v
 
+class MergeConflict(Exception):
+    """
+    Raised in non interactive mode when a merge or rebase has conflicts which could not be resolved automatically.
+    """
+    pass
+
+def load_config(cfg, schema, logger=None):
+    """
+    Parse and validate a kint config.
+    :param cfg: Kernel Integration Json config file.
+    :param schema: Kernel Integration Json schema file.
+    :param logger: Logger object.
+    :return: Config dict.
+    """
+    return JSONParser(cfg, schema, logger=logger).get_cfg()
+
+class KintPlan(object):
+    """
+    Dependency plan of the repos of a kint config. It only needs the parsed config and the durations of the previous
+    run, so the plan can be shown without touching the git repo.
+    """
+    def __init__(self, cfg, repo_dir, logger=None):
+        """
+        :param cfg: Parsed kint config dict.
+        :param repo_dir: Repo directory, the durations of the previous run are stored in its out directory.
+        :param logger: Logger object.
+        """
+        self.logger = logger or logging.getLogger(__name__)
+        self.repos = cfg['repos']
+        self.kint_repos = cfg['kint-list']
+        self._durations_file = os.path.join(repo_dir, 'out', 'kint-durations.json')
+
+    def _repo_names(self):
+        return [repo['repo-name'] for repo in self.repos]
+
+    def load_durations(self):
+        """
+        :return: Dict of repo name -> creation time (seconds) of the previous run.
+        """
+        if not os.path.exists(self._durations_file):
+            return {}
+
+        try:
+            with open(self._durations_file) as fobj:
+                return json.load(fobj)
+        except ValueError:
+            return {}
+
+    def save_durations(self, durations):
+        with open(self._durations_file, 'w+') as fobj:
+            json.dump(durations, fobj, indent=4, sort_keys=True)
+
+    def _repo_graph(self, durations={}):
+        """
+        Build the dependency graph of all repos. A repo depends on the repo whose dest-list creates a local branch used
+        (use-local) in its source-list, and a kint-repo also depends on its dep-repos. Cost of a repo is its creation
+        time in the previous run if known, otherwise the number of merge steps.
+        :param durations: Dict of repo name -> creation time of the previous run.
+        :return: (DepGraph, cost unit) tuple.
+        """
+        graph = DepGraph(logger=self.logger)
+        owners = {}
+        unit = 's' if len(durations) > 0 else ' steps'
+
+        for repo in self.repos:
+            sources = [srepo for srepo in repo['source-list'] if srepo['skip'] is False]
+            steps = max(len(sources), 1) * max(len(repo['dest-list']), 1)
+            graph.add_node(repo['repo-name'], durations.get(repo['repo-name'], 0) if len(durations) > 0 else steps)
+            for dest_repo in repo['dest-list']:
+                owners[dest_repo['local-branch']] = repo['repo-name']
+
+        for repo in self.repos:
+            for srepo in repo['source-list']:
+                if srepo['skip'] is False and srepo['use-local'] is True and srepo['branch'] in owners:
+                    graph.add_edge(repo['repo-name'], owners[srepo['branch']])
+
+        for repo in self.kint_repos:
+            for name in repo['dep-repos']:
+                if name in self._repo_names():
+                    graph.add_edge(repo['kint-repo'], name)
+
+        return graph, unit
+
+    def plan(self, repo_list, with_deps=True):
+        """
+        Get the dependency graph of given repos.
+        :param repo_list: List of repo names.
+        :param with_deps: Include the repos they depend on.
+        :return: (DepGraph, cost unit) tuple.
+        """
+        graph, unit = self._repo_graph(self.load_durations())
+
+        for name in repo_list:
+            if name not in self._repo_names():
+                self.logger.error("Repo %s does not exist\n" % name)
+
+        return graph.subgraph(repo_list, with_deps), unit
+
+    def kint_repo_list(self, kint_branch=None):
+        return [repo['kint-repo'] for repo in self.kint_repos if kint_branch is None or repo['kint-repo'] == kint_branch]
+
+    def show_plan(self, kint_branch=None, skip_dep=False):
+        """
+        Get the execution plan of KernelInteg.gen_kint_repos().
+        :param kint_branch: Name of the kernel branch.
+        :param skip_dep: Skip creating dependent branches.
+        :return: Plan string.
+        """
+        graph, unit = self.plan(self.kint_repo_list(kint_branch), skip_dep is False)
+
+        return graph.format_plan(unit)
+
 class KernelInteg(object):
 
     def _git(self, *args, **kwargs):
@@ -73,35 +199,43 @@ class KernelInteg(object):
             silent - Set True to supress any exceptions.
             wd - Work directory of git command.
             send_email - Set True if you want to send merge conflict email.
-            :return: None
+            dest - Destination branch name, the conflict is parked under it in non interactive mode.
+            :return: True if the command succeeded without conflicts, otherwise False.
         """
         yes = {'yes', 'y', 'ye', ''}
+        wd = kwargs.get('wd', self.repo_dir)
+        dest = kwargs.pop('dest', None)
 
         ret_code, std_out, std_err = self.git.cmd(*args, **kwargs)
 
         if ret_code != 0:
             use_manual_merge = True
-            self.logger.error(' '.join(self.git.curr_cmd) + " command failed")
+            self.logger.error(' '.join(args) + " command failed")
             self.logger.error(std_err)
 
-            status = self.git.cmd('diff')[1]
+            unresolved, resolved = self.git.conflict_state(wd=wd)
 
-            if kwargs.pop('auto_merge', False) == True and ">>>>>" not in status and "<<<<<<" not in status:
+            if kwargs.pop('auto_merge', False) == True and len(unresolved) == 0:
                 if "rebase" in list(args):
-                    while True:
-                        self.git.cmd('rebase', '--continue')
-                        if not os.path.exists(os.path.join(self.repo_dir, '.git/rebase-apply')):
+                    # Stage rerere resolutions and continue, until the rebase is done or stops on a new conflict.
+                    while len(unresolved) == 0 and self.git.rebase_in_progress(wd=wd):
+                        if len(resolved) > 0:
+                            self.git.cmd('add', '--', *resolved, wd=wd)
+                        ret = self.git.cmd('-c', 'core.editor=true', 'rebase', '--continue', wd=wd)[0]
+                        if ret != 0 and len(self.git.unmerged_paths(wd=wd)) == 0:
                             break
-                    status = self.git.cmd('diff')[1]
-                    if not ">>>>>" in status and not "<<<<<<" in status:
+                        unresolved, resolved = self.git.conflict_state(wd=wd)
+                    if len(unresolved) == 0 and not self.git.rebase_in_progress(wd=wd):
                         use_manual_merge = False
                 elif "merge" in list(args) or "pull" in list(args):
-                    self.git.cmd('commit','-as', '--no-edit')
-                    use_manual_merge = False
+                    if self.git.cmd('commit','-as', '--no-edit', wd=wd)[0] == 0:
+                        use_manual_merge = False
 
             if use_manual_merge is True:
+                if self.interactive is False:
+                    self._park_conflict(args, wd, std_out + std_err, dest)
                 if  kwargs.pop('send_email', False) is True:
-                    status = self.git.cmd('status')[1]
+                    status = self.git.cmd('status', wd=wd)[1]
                     content = "Following is the status of command: \n" + ' '.join(args) + '\n'
                     content += 'Stdout Message:\n\n' + std_out if len(std_out) > 0 else "None" + '\n'
                     content += 'Error Message:\n\n' + std_err if len(std_err) > 0 else "None" + '\n'
@@ -109,27 +243,67 @@ class KernelInteg(object):
                     self.send_email(subject_prefix=kwargs.pop('subject_prefix', ''),
                                     subject=kwargs.pop('subject', 'Merge Conflict'),
                                     content=content)
-                while True:
-                    print 'Please resolve the issue and then press y to continue'
-                    choice = raw_input().lower()
-                    if choice in yes:
-                        status = self.git.cmd('diff')[1]
-                        if ">>>>>" in status or "<<<<<<" in status:
-                            continue
-                        else:
-                            break
+                # Branches built in parallel share the terminal, resolve one conflict at a time.
+                with self._prompt_lock:
+                    while True:
+                        print 'Please resolve the issue in %s (git add the resolved files) and then press y to ' \
+                              'continue' % wd
+                        choice = raw_input().lower()
+                        if choice in yes:
+                            unresolved = self.git.unmerged_paths(wd=wd)
+                            if len(unresolved) > 0:
+                                print 'Unresolved files:\n\t' + '\n\t'.join(unresolved)
+                                continue
+                            else:
+                                break
+
+        return ret_code == 0
+
+    def _park_conflict(self, args, wd, output, dest):
+        """
+        Abort the conflicted merge or rebase in given work dir, record the conflict and block the destination branch.
+        :param args: Merge params.
+        :param wd: Work directory of the merge.
+        :param output: Output of the merge command.
+        :param dest: Destination branch name.
+        :return: Does not return, raises MergeConflict.
+        """
+        unresolved = self.git.unmerged_paths(wd=wd)
+
+        if self.git.rebase_in_progress(wd=wd):
+            self.git.cmd('rebase', '--abort', wd=wd)
+        else:
+            self.git.cmd('merge', '--abort', wd=wd)
+
+        self._conflicts.append({'dest': dest, 'command': 'git ' + ' '.join(args), 'files': unresolved,
+                                'output': output.strip()})
+
+        raise MergeConflict("%s blocked, %s has unresolved conflicts" % (dest, 'git ' + ' '.join(args)))
+
+    def conflict_report(self):
+        """
+        :return: Report of the merge conflicts parked in this run, empty string if there are none.
+        """
+        if len(self._conflicts) == 0:
+            return ''
+
+        content = "%d destination branches blocked by merge conflicts:\n\n" % len(self._conflicts)
+        for conflict in self._conflicts:
+            content += "%s: %s\n" % (conflict['dest'], conflict['command'])
+            content += ''.join(['\t%s\n' % name for name in conflict['files']])
+            if len(conflict['output']) > 0:
+                content += '\n\t' + conflict['output'].replace('\n', '\n\t') + '\n'
+            content += '\n'
+
+        return content
 
     def _is_valid_head(self, head):
         """
-        Check whether given SHA ID is valid or not. Executing git show <SHA ID> will fail if the <SHA ID> is incorrect.
+        Check whether given SHA ID is valid or not. Lookup is done using the persistent git cat-file session.
         :param head: SHA ID
         :return: True if the SHA ID or head is valid, otherwise return False.
         """
-        ret, out, err  = self.git.cmd('show', head)
-        if ret == 0:
-            return True
-
-        return False
+        return self.git.is_valid_ref(head)
 
     def _is_valid_local_branch(self, branch):
         """
@@ -137,16 +311,137 @@ class KernelInteg(object):
         :param branch: git branch name.
         :return: True if the branch name is valid, otherwise False.
         """
-        branches = self._git('branch')
-        self.logger.info(map(lambda it: it.strip().replace('* ', ''), branches.splitlines()))
+        branches = self.git.local_branches()
+        self.logger.info(branches)
         # Check if given branch name is branch of 'git branch' command output.
-        if branch not in map(lambda it: it.strip().replace('* ', ''), branches.splitlines()):
+        if branch not in branches:
             self.logger.error("%s invalid branch name\n" % branch)
             return False
 
         return True
 
-    def __init__(self, cfg, schema, repo_head='', repo_dir=os.getcwd(), subject_prefix='', skip_rr_cache=False, logger=None):
+    def _fetch_refspecs(self, merge_list):
+        """
+        Get the refspecs needed to update remote tracking branches of given remote branches.
+        :param merge_list: List of (remote, branch) tuple. Local branches (empty remote) are ignored.
+        :return: Dict of remote name -> list of refspecs.
+        """
+        refspecs = {}
+        for remote, branch in merge_list:
+            if remote == '':
+                continue
+            refspec = '+refs/heads/%s:refs/remotes/%s/%s' % (branch, remote, branch)
+            if refspec not in refspecs.setdefault(remote, []):
+                refspecs[remote].append(refspec)
+
+        return refspecs
+
+    def _source_branches(self, merge_mode=None):
+        """
+        Get the remote branches referenced by the source-list of all repos.
+        :param merge_mode: Only include the repos with a destination branch of given merge mode, None for all repos.
+        :return: List of (remote, branch) tuple.
+        """
+        branches = []
+        for repo in self.repos:
+            if merge_mode is not None and merge_mode not in [dest['merge-mode'] for dest in repo['dest-list']]:
+                continue
+            for srepo in repo['source-list']:
+                if srepo['skip'] is True or srepo['use-local'] is True:
+                    continue
+                branches.append((srepo['url'], srepo['branch']))
+
+        return branches
+
+    def _remote_refs(self):
+        """
+        :return: Dict of remote tracking branch -> SHA ID.
+        """
+        out = self._git('for-each-ref', '--format=%(refname) %(objectname)', 'refs/remotes/')
+
+        return dict([line.split(' ', 1) for line in out.splitlines() if len(line) > 0])
+
+    def _fetch_remotes(self, remotes, refspecs={}, git=None):
+        """
+        Fetch given remotes concurrently, one git fetch (and one negotiation) per remote.
+        :param remotes: List of remote names.
+        :param refspecs: Dict of remote name -> list of refspecs to fetch. Remotes without refspecs are fetched
+        completely.
+        :param git: GitShell of the repo to fetch into, None for repo directory. Fetch filter is only used for repo
+        directory.
+        :return: None
+        """
+        if len(remotes) == 0:
+            return
+
+        use_filter = git is None and self.fetch_filter is not None
+        git = git or self.git
+
+        loop = CmdLoop(max_jobs=self.fetch_jobs if self.fetch_jobs > 0 else len(remotes), logger=self.logger)
+        fetch_list = []
+
+        for name in remotes:
+            options = ['fetch', '--progress']
+            if self.git_fetch_jobs > 0:
+                options.append('--jobs=%d' % self.git_fetch_jobs)
+            if use_filter is True:
+                # Partial clone, git registers the remote as promisor and fetches missing objects on demand.
+                options.append('--filter=' + self.fetch_filter)
+            options.append(name)
+            options += refspecs.get(name, [])
+            fetch_list.append((name, git.cmd_async(*options, loop=loop)))
+
+        loop.gather(*[future for name, future in fetch_list])
+
+        # Size of the received pack, as reported by git progress output.
+        def received_size(err):
+            match = re.findall(r"Receiving objects:.*?,\s*([0-9.]+ [KMG]?i?B)", str(err))
+            return match[-1] if len(match) > 0 else '0 B'
+
+        failed = []
+        for name, future in fetch_list:
+            ret, out, err = future.result()
+            self.logger.info("Fetched %-24s in %8.2fs, received %s" % (name, future.duration(), received_size(err)))
+            if ret != 0:
+                self.logger.error("Fetching remote %s failed" % name)
+                self.logger.error(err)
+                failed.append(name)
+
+        if len(failed) > 0:
+            raise Exception("Fetching remotes %s failed" % ', '.join(failed))
+
+    def _update_mirror(self, refspecs={}):
+        """
+        Update the shared mirror repo with the remote branches and borrow its objects (git alternates), so that the
+        fetch of repo directory only transfers objects which are not in the mirror yet. Mirror is shared by all
+        workspaces, so its updates are serialised with a lock file, and its unreachable objects are never pruned
+        since workspaces may still use them.
+        :param refspecs: Dict of remote name -> list of refspecs to fetch.
+        :return: None
+        """
+        self.logger.info(format_h1("Update mirror %s", tab=2) % self.mirror_dir)
+
+        if not os.path.exists(self.mirror_dir):
+            os.makedirs(self.mirror_dir)
+
+        mirror = GitShell(wd=self.mirror_dir, logger=self.logger)
+        mirror.cmd('config', 'gc.pruneExpire', 'never')
+        for remote in self.remote_list:
+            # Keep existing remotes, removing one would drop its refs and the next fetch would start from scratch.
+            if mirror.cmd('remote', 'add', remote['name'], remote['url'])[0] != 0:
+                mirror.cmd('remote', 'set-url', remote['name'], remote['url'])
+
+        with open(os.path.join(self.mirror_dir, '.git', 'kint-mirror.lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            start = time.time()
+            self._fetch_remotes([remote['name'] for remote in self.remote_list], refspecs, git=mirror)
+            self.logger.info("Updated mirror in %.2fs" % (time.time() - start))
+
+        self.git.add_alternate(os.path.join(self.mirror_dir, '.git', 'objects'))
+
+    def __init__(self, cfg, schema, repo_head='', repo_dir=os.getcwd(), subject_prefix='', skip_rr_cache=False,
+                 fetch_jobs=0, git_fetch_jobs=0, narrow_fetch=True, dest_jobs=1, repo_jobs=1, use_integ_cache=True,
+                 resume=False, interactive=True, mirror_dir=None, fetch_filter=None, logger=None):
         # type: (json, jsonschema, str, str, str, boolean, boolean) -> object
         """
         Constructor of KernelInteg class.
@@ -157,10 +452,26 @@ class KernelInteg(object):
         :param repo_dir: Repo directory.
         :param subject_prefix: Prefix for email subject.
         :param skip_rr_cache: Skip rr cache if set True.
+        :param fetch_jobs: Max number of remotes fetched in parallel, 0 to fetch all remotes in parallel.
+        :param git_fetch_jobs: Value passed to git fetch --jobs, 0 to use git default.
+        :param narrow_fetch: Fetch only the remote branches used in source lists.
+        :param dest_jobs: Max number of destination branches of a repo built in parallel (each one in its own
+        git worktree). 1 builds them one by one in repo directory.
+        :param repo_jobs: Max number of independent repos built in parallel (each one in its own git worktree). 1
+        builds them one by one, in dependency order, in repo directory.
+        :param use_integ_cache: Reuse merge results of previous runs when source branches did not change.
+        :param resume: Skip the fetches, merges, tests and uploads already completed by the previous run, if the SHA
+        IDs they were run on did not change.
+        :param interactive: Wait for manual resolution of merge conflicts. If False, conflicted merges are aborted,
+        the destination branch is marked as blocked and the conflicts are reported at the end of the run.
+        :param mirror_dir: Local mirror repo shared by workspaces. It is updated first, and repo directory borrows its
+        objects instead of downloading them again.
+        :param fetch_filter: Partial clone filter (like blob:none) used to fetch into repo directory. Filtered objects
+        are fetched on demand.
         :param logger: Logger object
         """
         self.logger = logger or logging.getLogger(__name__)
-        self.cfg = JSONParser(cfg, schema, logger=self.logger).get_cfg()
+        self.cfg = load_config(cfg, schema, logger=self.logger)
         self.remote_list = self.cfg['remote-list']
         self.repos = self.cfg['repos']
         self.kint_repos = self.cfg['kint-list']
@@ -169,6 +480,21 @@ class KernelInteg(object):
         self.repo_dir = repo_dir
         self.skip_rr_cache = skip_rr_cache
         self.subject_prefix = subject_prefix
+        self.fetch_jobs = fetch_jobs
+        self.git_fetch_jobs = git_fetch_jobs
+        self.narrow_fetch = narrow_fetch
+        self.dest_jobs = dest_jobs
+        self.repo_jobs = repo_jobs
+        self.interactive = interactive
+        self.mirror_dir = os.path.abspath(mirror_dir) if mirror_dir is not None else None
+        self.fetch_filter = fetch_filter
+        # Conflicts parked in non interactive mode, list of dicts.
+        self._conflicts = []
+        self._prompt_lock = threading.Lock()
+        self._rr_cache_lock = threading.Lock()
+        # Results of repos created in this run, repo name -> status or exception.
+        self._repo_results = {}
+        self.planner = KintPlan(self.cfg, self.repo_dir, logger=self.logger)
         # All git commands will be executed in repo directory.
         self.git = GitShell(wd=self.repo_dir, logger=self.logger)
 
@@ -177,6 +503,18 @@ class KernelInteg(object):
         if not os.path.exists(os.path.join(self.repo_dir, ".git")):
             self._git("init", ".")
 
+        # A replayed run does not have the recorded repo (its git dir may not exist), so the integration cache and
+        # journal are kept in memory only.
+        persist = get_transcript() is None or not get_transcript().replaying()
+
+        self.integ_cache = IntegCache(self.git, self.repo_dir, persist=persist,
+                                      logger=self.logger) if use_integ_cache else None
+
+        # Journal lives in git dir, so that it survives cleaning the repo and out directory.
+        common_dir = self._git('rev-parse', '--git-common-dir').strip() or '.git'
+        self.journal = RunJournal(os.path.join(self.repo_dir, common_dir, 'kint-journal.json'), resume,
+                                  persist=persist, logger=self.logger)
+
         # Create out dir if its not exists.
         out_dir = os.path.join(self.repo_dir, 'out')
         if not os.path.exists(out_dir):
@@ -189,7 +527,27 @@ class KernelInteg(object):
             self._git("remote", "add", remote['name'], remote['url'], silent=True)
 
         # Get the latest updates
-        self._git("remote", "update")
+        self.logger.info(format_h1("Fetch remotes", tab=2))
+        refspecs = self._fetch_refspecs(self._source_branches()) if self.narrow_fetch is True else {}
+        fetched = self.journal.get('fetch', refspecs)
+        if fetched is not None and fetched == self._remote_refs():
+            # Merges of the resumed run must see the same remote branches as the completed steps.
+            self.logger.info("Skipping fetch, remote branches match the journal")
+        else:
+            if self.mirror_dir is not None:
+                self._update_mirror(refspecs)
+            start = time.time()
+            self._fetch_remotes([remote['name'] for remote in self.remote_list], refspecs)
+            self.logger.info("Fetched %d remotes in %.2fs" % (len(self.remote_list), time.time() - start))
+            if self.narrow_fetch is False:
+                # Merge mode merges from remote tracking branches, so update its source branches explicitly (a full
+                # fetch only follows the configured fetch refspecs). Done once here, never per destination branch.
+                merge_refspecs = self._fetch_refspecs(self._source_branches('merge'))
+                start = time.time()
+                self._fetch_remotes(merge_refspecs.keys(), merge_refspecs)
+                self.logger.info("Fetched %d merge source branches in %.2fs" %
+                                 (sum(map(len, merge_refspecs.values())), time.time() - start))
+            self.journal.record('fetch', refspecs, self._remote_refs())
 
         valid_repo_head = False
 
@@ -214,20 +572,44 @@ class KernelInteg(object):
         # Checkout some random HEAD
         self._git("checkout", 'HEAD~1', silent=True)
 
-    def clean_repo(self):
+    def clean_repo(self, keep_patterns=[], clean_out=False):
         """
-        Clean the git repo and delete all local branches.
+        Clean the git repo and delete all local branches. Branches are deleted in a single update-ref transaction.
+        :param keep_patterns: List of glob patterns of branch names to keep.
+        :param clean_out: Set True to also delete the out directory (build output, worktrees) and the quilt output
+        folders.
         :return: None
         """
         self.logger.info(format_h1("Cleaning repo", tab=2))
         self._git("reset", "--hard")
-        self._git("clean", "-fdx")
-
-        local_branches = [x.strip() for x in self._git('branch').splitlines()]
-        for branch in local_branches:
-            if branch.startswith('* '):
+        if clean_out is True:
+            self._git("clean", "-fdx")
+        else:
+            # Quilt folders are kept, so that the next export only formats new or changed patches.
+            excludes = ["-e", "/out/"]
+            for folder in self._quilt_folders():
+                excludes += ["-e", "/%s/" % os.path.relpath(folder, self.repo_dir)]
+            self._git("clean", "-fdx", *excludes)
+        self._git("worktree", "prune")
+
+        # Skip current branch and branches checked out in other worktrees.
+        commands = []
+        out = self._git('for-each-ref', '--format=%(refname)%00%(objectname)%00%(HEAD)%00%(worktreepath)',
+                        'refs/heads/')
+        for line in out.splitlines():
+            ref, sha, head, worktree = line.split('\0')
+            branch = ref[len('refs/heads/'):]
+            if head == '*' or len(worktree) > 0:
+                continue
+            if any([fnmatch.fnmatch(branch, pattern) for pattern in keep_patterns]):
                 continue
-            self._git("branch", "-D", branch)
+            commands.append('delete %s %s\n' % (ref, sha))
+
+        if len(commands) == 0:
+            return
+
+        self.logger.info("Deleting %d branches" % len(commands))
+        self._git("update-ref", "--stdin", input=''.join(commands))
 
     def send_email(self, to='', cc='', subject_prefix='', subject='test subject',  content='test content'):
         # type: (str, str, str, str, str) -> None
@@ -250,8 +632,8 @@ class KernelInteg(object):
                        subject=prefix + ' ' + subject,
                        content=content)
 
-    def _compile_test(self, options):
-        # type: (dict) -> boolean, str
+    def _compile_test(self, options, wd=None):
+        # type: (dict, str) -> boolean, str
         """
         Run selected compile tests for selected architectures.
         Supported architectures are,  i386, x86_64, arm64.
@@ -267,12 +649,14 @@ class KernelInteg(object):
         allnoconfig - Option to select allnoconfig configuration.
         allmodconfig - Option to select allmodconfig configuration.
         defconfig - Option to select defconfig configuration.
+        :param wd: Kernel source directory, default is repo directory.
 
         :return: Overal status of compile tests, and test output. Deafult status is True and output is empty string.
         """
         supported_archs = ['i386', 'x86_64', 'arm64']
         supported_configs = ['allyesconfig', 'allnoconfig', 'allmodconfig', 'defconfig']
         status = True
+        wd = wd or self.repo_dir
 
         self.logger.info(format_h1("Compile tests", tab=2))
 
@@ -315,10 +699,10 @@ class KernelInteg(object):
 
             for config in supported_configs:
                 if params[config] is True:
-                    out_dir = os.path.join(self.repo_dir, 'out', arch, config)
+                    out_dir = os.path.join(wd, 'out', arch, config)
                     ret, out, err = 0, '', ''
 
-                    kobj = BuildKernel(src_dir=self.repo_dir, out_dir=out_dir,
+                    kobj = BuildKernel(src_dir=wd, out_dir=out_dir,
                                        arch=params['arch_name'],
                                        cc=params['compiler_options']['CC'],
                                        cflags=params['compiler_options']['cflags'],
@@ -370,7 +754,7 @@ class KernelInteg(object):
 
         return generate_results(results)
 
-    def _test_branch(self, branch_name, test_options):
+    def _test_branch(self, branch_name, test_options, wd=None):
         """
         Test given branch and return the status of tests.
         :param branch_name: Name of the kernel branch.
@@ -380,6 +764,7 @@ class KernelInteg(object):
                            "static-analysis",
                            "bat-tests".
                 Options assosiated with these profiles are defined in self.test_profiles.
+        :param wd: Work directory (repo directory or worktree) of the branch.
 
         :return: Status of the test.
         """
@@ -388,12 +773,13 @@ class KernelInteg(object):
         status = True
         out = '\n\n'
 
-        self._git("checkout", branch_name)
+        wd = wd or self.repo_dir
+        self._git("checkout", branch_name, wd=wd)
 
         # For every test profile, run test and gather status and output.
         for profile in profile_list:
             if profile == 'compile-tests':
-                test_status, test_out = self._compile_test(self.test_profiles['compile-tests'])
+                test_status, test_out = self._compile_test(self.test_profiles['compile-tests'], wd)
                 out += test_out
                 if test_status is False:
                     status = False
@@ -413,12 +799,37 @@ class KernelInteg(object):
 
         return status
 
+    def _quilt_folder(self, quilt_params):
+        """
+        :param quilt_params: Dict with quilt output options.
+        :return: Absolute path of the quilt folder.
+        """
+        if quilt_params["quilt-folder"] != "":
+            return os.path.abspath(os.path.join(self.repo_dir, quilt_params["quilt-folder"]))
+
+        return os.path.abspath(os.path.join(self.repo_dir, 'quilt'))
+
+    def _quilt_folders(self):
+        """
+        :return: List of quilt folders inside repo directory used by the destination branches.
+        """
+        folders = []
+        for repo in self.repos:
+            for dest_repo in repo['dest-list']:
+                output_options = dest_repo.get('output-options', None) or {}
+                if dest_repo.get('generate-output', False) is not True or output_options.get('quilt') is None:
+                    continue
+                folder = self._quilt_folder(output_options['quilt'])
+                if folder.startswith(os.path.abspath(self.repo_dir) + os.sep) and folder not in folders:
+                    folders.append(folder)
+
+        return folders
+
     def _generate_output(self, head, branch_name, output_options):
         """
         Generate alternate outputs for given repo. Currently supported format is 'quilt'.
-        If quilt option is selected, then following command are executed.
-        git format-patch -C -M HEAD..<branch_name SHA_ID> -o quilt-folder.
-        Write patch names back to series file.
+        If quilt option is selected, HEAD..<branch_name SHA_ID> is exported to quilt-folder. Patches of the previous
+        export are re-used, only new or changed commits are formatted again. Patch names are written to series file.
 
         :param head: SHA ID or Tag of head of the kernel branch.
         :param branch_name: Name of the branch.
@@ -432,29 +843,32 @@ class KernelInteg(object):
         quilt_params = output_options.get('quilt', None)
 
         if quilt_params is not None:
-            quilt_folder = os.path.join(self.repo_dir, 'quilt')
-            if quilt_params["quilt-folder"] != "":
-                quilt_folder = os.path.join(self.repo_dir, quilt_params["quilt-folder"])
+            quilt_folder = self._quilt_folder(quilt_params)
 
             self.logger.info(format_h1("Generating quilt patches in %s", tab=2) % quilt_folder)
             self.logger.info(quilt_folder)
 
-            if os.path.exists(quilt_folder):
-                rmtree(quilt_folder, ignore_errors=True)
-
-            os.makedirs(quilt_folder)
             tail = self.git.cmd('rev-parse', branch_name)[1]
-            err_code, output, err =  self.git.cmd('format-patch', '-C', '-M',
-                                                        head.strip() + '..' + tail.strip(),
-                                                        '-o', quilt_folder)
-            if err_code == 0:
-                def get_file_name(path):
-                    head, tail =  os.path.split(path)
-                    return tail
-                with open(os.path.join(quilt_folder, 'series.txt'), 'w') as f:
-                    patch_list = map(get_file_name, output.split('\n'))
-                    f.write(str('\n'.join(patch_list)))
+            try:
+                QuiltExporter(self.git, quilt_folder, series_name='series.txt', logger=self.logger).export(head, tail)
+            except Exception as e:
+                self.logger.error(e)
+
+
+    def _rr_cache_incremental(self, params):
+        return params['remote-cache-params'].get('sync-mode', 'full') == 'incremental'
+
+    def _rr_cache_sync(self, remote_params, protocol):
+        """
+        Get the incremental synchronizer of local rr cache with the remote cache.
+        :param remote_params: Dict with remote-cache-params.
+        :param protocol: Remote protocol (smb, rsync, local).
+        :return: RRCacheSync object.
+        """
+        backend = get_backend(protocol, remote_params, logger=self.logger)
 
+        return RRCacheSync(os.path.join(self.repo_dir, '.git', 'rr-cache'), backend,
+                           remote_params.get('max-age-days', DEFAULT_MAX_AGE_DAYS), logger=self.logger)
 
     def _config_rr_cache(self, params):
         """
@@ -466,6 +880,8 @@ class KernelInteg(object):
                                 - sync-protocol - Remote sync protocol (SMB, Rsync)
                                 - server-name - Name of the remote server.
                                 - Share-point - Name of the share folder.
+                                - sync-mode - "full" to replace the local cache with the remote one using
+                                  sync-options, "incremental" to download only new or changed entries.
 
         :return:
         """
@@ -485,7 +901,10 @@ class KernelInteg(object):
             self._git("config", "rerere.autoupdate", "true")
 
         # Check and add remote cache
-        if params['use-remote-cache'] == True:
+        if params['use-remote-cache'] == True and self._rr_cache_incremental(params) is True:
+            remote_params = params['remote-cache-params']
+            self._rr_cache_sync(remote_params, remote_params['sync-protocol']).pull()
+        elif params['use-remote-cache'] == True:
             remote_params = params['remote-cache-params']
             if os.path.exists(rr_cache_dir):
                 rmtree(rr_cache_old_dir, ignore_errors=True)
@@ -525,7 +944,10 @@ class KernelInteg(object):
         sh = PyShell(wd=self.repo_dir, logger=self.logger)
 
         if params.get('upload-remote-cache', False) is True and os.path.exists(rr_cache_dir):
-            if params['use-remote-cache'] == True:
+            if params['use-remote-cache'] == True and self._rr_cache_incremental(params) is True:
+                remote_params = params['remote-cache-params']
+                self._rr_cache_sync(remote_params, remote_params['upload-protocol']).push()
+            elif params['use-remote-cache'] == True:
                 remote_params = params['remote-cache-params']
                 if remote_params['upload-protocol'] == 'smb':
                     cmd = ["//" + remote_params['server-name'] + '/' + remote_params['share-point']]
@@ -543,11 +965,90 @@ class KernelInteg(object):
                     self.logger.error(err)
                     self.logger.error(out)
 
-        if params['use-remote-cache'] == True  and os.path.exists(rr_cache_old_dir):
+        if params['use-remote-cache'] == True and self._rr_cache_incremental(params) is False and \
+                os.path.exists(rr_cache_old_dir):
             rmtree(rr_cache_dir, ignore_errors=True)
             sh.cmd('mv', rr_cache_old_dir, rr_cache_dir)
 
-    def _merge_branches(self, mode, merge_list, dest, params):
+    def _octopus_merge(self, options, refs, dest, params, wd):
+        """
+        Merge the given refs with a single octopus merge. If it fails, split the refs in two halves and merge them one
+        after another the same way, until the conflicting branches are isolated and merged alone (using rr cache and
+        manual resolution like a normal merge).
+        :param options: git merge command and options.
+        :param refs: List of refs to merge.
+        :param dest: Dest branch name.
+        :param params: Dict with merge params.
+        :param wd: Work directory of dest branch.
+        :return: List of refs which had to be merged alone because of conflicts.
+        """
+        if len(refs) == 0:
+            return []
+
+        if len(refs) == 1:
+            if self._git_merge(*(options + refs), send_email=True, dest=dest, subject_prefix=dest,
+                               subject='Merge Failed', auto_merge=params['use-rr-cache'], wd=wd) is True:
+                return []
+            return refs
+
+        head = self.git.rev_parse('HEAD', wd=wd)
+        ret, out, err = self.git.cmd(*(options + ['--no-edit'] + refs), wd=wd)
+        if ret == 0:
+            self.logger.info("Octopus merged %d branches into %s" % (len(refs), dest))
+            return []
+
+        self.logger.warn("Octopus merge of %d branches failed, splitting them" % len(refs))
+        self._git("reset", "--hard", head, wd=wd)
+
+        half = len(refs) / 2
+        conflicts = self._octopus_merge(options, refs[:half], dest, params, wd)
+        conflicts += self._octopus_merge(options, refs[half:], dest, params, wd)
+
+        return conflicts
+
+    def _preflight_merge(self, refs, dest, wd):
+        """
+        Simulate the merge of given refs on top of dest branch in memory (git merge-tree), without touching the work
+        tree. A conflicting ref is left out of the simulation, so conflicts of the following refs are still found.
+        rr cache resolutions are not applied, so conflicts which rerere could resolve are reported too.
+        :param refs: List of refs to merge.
+        :param dest: Dest branch name.
+        :param wd: Work directory of dest branch.
+        :return: List of (ref, list of refs it conflicts with, list of conflicting files) tuple. Empty list if the
+        check could not be done.
+        """
+        head = self.git.rev_parse('HEAD', wd=wd)
+        base = head
+        merged = []
+        changes = {}
+        conflicts = []
+
+        def changed_files(ref):
+            if ref not in changes:
+                changes[ref] = set(self.git.cmd('diff', '--name-only', head + '...' + ref, wd=wd)[1].splitlines())
+            return changes[ref]
+
+        for ref in refs:
+            status, tree, files, messages = self.git.merge_tree(base, ref, wd=wd)
+            if status == 'clean':
+                ret, out, err = self.git.cmd('commit-tree', tree, '-p', base, '-p', ref, '-m', 'Merge ' + ref, wd=wd)
+                if ret != 0:
+                    self.logger.warn("Pre-flight merge check of %s unavailable, merging normally. %s" %
+                                     (dest, err.strip()))
+                    return []
+                base = out.strip()
+                merged.append(ref)
+            elif status == 'conflict':
+                peers = [peer for peer in merged if len(changed_files(peer) & set(files)) > 0]
+                conflicts.append((ref, peers or [dest + ' base'], files))
+            else:
+                # merge-tree itself failed (git older than 2.38, bad ref), that is not a conflict of the ref.
+                self.logger.warn("Pre-flight merge check of %s unavailable, merging normally. %s" % (dest, messages))
+                return []
+
+        return conflicts
+
+    def _merge_branches(self, mode, merge_list, dest, params, wd=None, config_rr_cache=True):
         """
         Merge the branches given in merge_list and create a output branch.
         Basic logic is,
@@ -560,71 +1061,273 @@ class KernelInteg(object):
         use-rr-cache -  Use git rerere cache.
         no-ff - Set True if you want to disable fast forward in merge.
         add-log - Set True if you want to add merge log.
+        merge-strategy - "serial" to merge branches one by one, "octopus" to try a single octopus merge first.
+        preflight-check - Find all merge conflicts in memory before merging, and report them at once.
+        skip-conflicting - Do not merge the branches for which pre-flight check found conflicts.
+        :param wd: Work directory (repo directory or worktree) of dest branch.
+        :param config_rr_cache: Set False if rr cache is configured by the caller.
 
         :return: True
         """
+        wd = wd or self.repo_dir
         rr_cache_params = params.get('rr-cache', None)
-        if self.skip_rr_cache == False and params['use-rr-cache'] is True:
+        config_rr_cache = config_rr_cache and self.skip_rr_cache == False and params['use-rr-cache'] is True
+        self._git("checkout", dest, wd=wd)
+
+        # Remote tracking branches are updated once per run (see __init__), and never from worker threads.
+        refs = [remote + '/' + branch if remote != '' else branch for remote, branch in merge_list]
+
+        # Reuse the longest prefix of merge steps whose inputs did not change since the last run.
+        keys, shas = [], []
+        if self.integ_cache is not None:
+            cache_options = {'mode': mode, 'no-ff': params['no-ff'], 'add-log': params['add-log'],
+                             'merge-strategy': params['merge-strategy']}
+            tips = [(ref, self.git.rev_parse(ref, wd=wd)) for ref in refs]
+            keys = self.integ_cache.keys(self.git.rev_parse('HEAD', wd=wd), cache_options, tips)
+            count, sha = self.integ_cache.lookup(dest, keys)
+            if count > 0:
+                self.logger.info("%s: reusing %d of %d merge steps from integration cache" % (dest, count, len(refs)))
+                self._git("reset", "--hard", sha, wd=wd)
+                shas = [step[1] for step in self.integ_cache.entries[dest][:count]]
+                refs = refs[count:]
+
+        if mode == "merge" and len(refs) > 0 and params['preflight-check'] is True:
+            conflicts = self._preflight_merge(refs, dest, wd)
+            if len(conflicts) > 0:
+                content = "Pre-flight merge check of %s found %d conflicting branches:\n\n" % (dest, len(conflicts))
+                for ref, peers, files in conflicts:
+                    content += "%s conflicts with %s\n" % (ref, ', '.join(peers) if len(peers) > 0 else 'unknown')
+                    content += ''.join(['\t%s\n' % name for name in files])
+                self.logger.warn(content)
+                self.send_email(subject_prefix=dest, subject='Merge Conflicts', content=content)
+
+                if params['skip-conflicting'] is True:
+                    skipped = [ref for ref, peers, files in conflicts]
+                    self.logger.warn("%s: skipping %s" % (dest, ', '.join(skipped)))
+                    refs = [ref for ref in refs if ref not in skipped]
+                    # Result does not match the inputs anymore, cache only the reused steps.
+                    keys = keys[:len(shas)]
+
+        if len(refs) > 0 and config_rr_cache is True:
+            # rr cache directory is shared by all worktrees, so merges using it can't overlap.
+            self._rr_cache_lock.acquire()
             self._config_rr_cache(rr_cache_params)
-        self._git("checkout", dest)
-        if mode == "merge":
-            for remote, branch in merge_list:
-                options = []
+
+        try:
+            start = time.time()
+            if mode == "merge" and len(refs) > 0:
+                options = ["merge"]
                 if params['no-ff'] is True:
                     options.append('--no-ff')
                 if params['add-log'] is True:
                     options.append('--log')
-                if remote != '':
-                    options.append(remote)
-                    options = ["pull"] + options
-                else:
-                    options = ["merge"] + options
-                options.append(branch)
-
-                self._git_merge(*options, send_email=True, subject_prefix=dest, subject='Merge Failed',
-                                auto_merge=params['use-rr-cache'])
-        elif mode == "rebase":
-            for remote, branch in merge_list:
-                if remote != '':
-                    self._git("checkout", remote + '/' + branch)
-                else:
-                    self._git("checkout", branch)
-                self._git_merge("rebase", dest, send_email=True, subject_prefix=dest, subject='Rebase Failed',
-                                auto_merge=params['use-rr-cache'])
-                self._git("branch", '-D', dest)
-                self._git("checkout", '-b', dest)
 
-        if self.skip_rr_cache == False and params['use-rr-cache'] is True:
-            self._reset_rr_cache(rr_cache_params)
+                if params['merge-strategy'] == 'octopus':
+                    conflicts = self._octopus_merge(options, refs, dest, params, wd)
+                    if len(conflicts) > 0:
+                        self.logger.warn("Conflicting branches in %s: %s" % (dest, ', '.join(conflicts)))
+                    shas += [None] * (len(refs) - 1) + [self.git.rev_parse('HEAD', wd=wd)]
+                else:
+                    for ref in refs:
+                        self._git_merge(*(options + [ref]), send_email=True, dest=dest, subject_prefix=dest,
+                                        subject='Merge Failed', auto_merge=params['use-rr-cache'], wd=wd)
+                        shas.append(self.git.rev_parse('HEAD', wd=wd))
+            elif mode == "rebase":
+                for ref in refs:
+                    self._git("checkout", ref, wd=wd)
+                    self._git_merge("rebase", dest, send_email=True, dest=dest, subject_prefix=dest,
+                                    subject='Rebase Failed', auto_merge=params['use-rr-cache'], wd=wd)
+                    self._git("branch", '-D', dest, wd=wd)
+                    self._git("checkout", '-b', dest, wd=wd)
+                    shas.append(self.git.rev_parse('HEAD', wd=wd))
+
+            self.logger.info("%s: merged %d branches in %.2fs" % (dest, len(refs), time.time() - start))
+        finally:
+            if len(refs) > 0 and config_rr_cache is True:
+                self._reset_rr_cache(rr_cache_params)
+                self._rr_cache_lock.release()
+
+        if self.integ_cache is not None:
+            self.integ_cache.store(dest, keys, shas)
 
         return True
 
 
-    def _upload_branch(self, branch_name, upload_options):
+    def _upload_branches(self, uploads):
         """
-        Upload the given branch to a remote patch.
+        Upload the given branches to remote paths, with a single push per remote. Different remotes are pushed
+        concurrently.
         supported upload modes are force-push, push and refs-for (for Gerrit).
-        :param branch_name: Name of the local branch.
-        :param upload_options: Dict with upload related params.
+        :param uploads: List of (local branch name, upload options) tuples. Upload options is a Dict with upload
+        related params.
         url - Name of the git remote.
         branch - Remote branch of git repo.
-        :return: Nothing.
+        :return: (uploaded, failed) tuple of lists of branch names.
         """
-        self.logger.info(format_h1("Uploading %s", tab=2) % branch_name)
+        refspecs = {}
+        for branch_name, upload_options in uploads:
+            self.logger.info(format_h1("Uploading %s", tab=2) % branch_name)
+            if upload_options['mode'] == 'force-push':
+                refspec = '+' + branch_name + ":" + upload_options['branch']
+            elif upload_options['mode'] == 'push':
+                refspec = branch_name + ":" + upload_options['branch']
+            elif upload_options['mode'] == 'refs-for':
+                refspec = branch_name + ":refs/for/" + upload_options['branch']
+            else:
+                continue
+            refspecs.setdefault(upload_options['url'], []).append((branch_name, refspec))
+
+        remotes = refspecs.keys()
+        results = push_refs([(self.git, remote, [refspec for branch_name, refspec in refspecs[remote]])
+                             for remote in remotes], jobs=self.fetch_jobs, logger=self.logger)
+
+        uploaded = []
+        failed = []
+        for remote, (ret, refs, err) in zip(remotes, results):
+            pushed = dict([(src_ref, flag) for src_ref, dst_ref, flag, summary in refs])
+            for src_ref, dst_ref, flag, summary in refs:
+                self.logger.info("%s: %s -> %s %s" % (remote, src_ref, dst_ref, summary))
+            for branch_name, refspec in refspecs[remote]:
+                if pushed.get('refs/heads/' + branch_name, '!') == '!':
+                    failed.append(branch_name)
+                else:
+                    uploaded.append(branch_name)
+            if ret != 0:
+                self.logger.error(err)
+
+        return uploaded, failed
+
+    def _create_dest_branch(self, repo, dest_repo, merge_list, wd=None, config_rr_cache=True):
+        """
+        Merge the source branches into an already created destination branch and test it.
+        :param repo: Dict with kernel repo options.
+        :param dest_repo: Dict with destination branch options.
+        :param merge_list: List of (remote, branch) tuple.
+        :param wd: Work directory (repo directory or worktree) of the destination branch.
+        :param config_rr_cache: Set False if rr cache is configured by the caller.
+        :return: Test status of the branch, True if testing is not enabled.
+        """
+        dest = dest_repo['local-branch']
+        wd = wd or self.repo_dir
+
+        if len(merge_list) > 0:
+            inputs = self._merge_inputs(self.git.rev_parse('HEAD', wd=wd), dest_repo, merge_list, wd)
+            sha = self.journal.get('merge:' + dest, inputs)
+            if sha is not None and self.git.is_valid_ref(sha + '^{commit}', wd=wd) is True:
+                self.logger.info("%s: reusing merge result %s from journal" % (dest, sha))
+                self._git("reset", "--hard", sha, wd=wd)
+            else:
+                self._merge_branches(dest_repo['merge-mode'], merge_list, dest,
+                                     dest_repo['merge-options'], wd=wd, config_rr_cache=config_rr_cache)
+                self.journal.record('merge:' + dest, inputs, self.git.rev_parse('HEAD', wd=wd))
+
+        if dest_repo['test-branch'] is True:
+            test_options = dest_repo['test-options']
+            inputs = [self.git.rev_parse('HEAD', wd=wd), test_options]
+            if self.journal.get('test:' + dest, inputs) is True:
+                self.logger.info("%s: skipping tests, already passed on %s" % (dest, inputs[0]))
+            else:
+                status = self._test_branch(dest, test_options, wd=wd)
+                self.journal.record('test:' + dest, inputs, status)
+                if status is False:
+                    self.logger.error("Testing %s branch failed" % dest)
+                    return False
+
+        return True
+
+    def _merge_inputs(self, head, dest_repo, merge_list, wd):
+        """
+        :return: Inputs of the merge step of a destination branch, used to validate its journal entry.
+        """
+        refs = [remote + '/' + branch if remote != '' else branch for remote, branch in merge_list]
+
+        return {'head': head, 'mode': dest_repo['merge-mode'], 'options': dest_repo['merge-options'],
+                'tips': [[ref, self.git.rev_parse(ref, wd=wd)] for ref in refs]}
+
+    def _create_dest_branches_parallel(self, repo, merge_list):
+        """
+        Create the destination branches of given repo in parallel, each one in its own git worktree under
+        out/worktrees. At most dest_jobs branches are built at the same time. Worktrees are removed once all branches
+        are built, created branches are kept.
+        :param repo: Dict with kernel repo options.
+        :param merge_list: List of (remote, branch) tuple.
+        :return: True if all branches are created and their tests passed, otherwise False.
+        """
+        self.logger.info(format_h1("Create %d destination branches in parallel", tab=2) % len(repo['dest-list']))
+
+        # rr cache directory is shared by all worktrees, so configure it only once.
+        rr_cache_params = None
+        for dest_repo in repo['dest-list']:
+            params = dest_repo['merge-options']
+            if self.skip_rr_cache == False and params['use-rr-cache'] is True and len(merge_list) > 0:
+                rr_cache_params = params.get('rr-cache', None)
+                break
+
+        worktree_dir = os.path.join(self.repo_dir, 'out', 'worktrees')
+        slots = threading.Semaphore(self.dest_jobs)
+        results = {}
+        workers = []
+        worktrees = []
+        rr_cache_locked = False
+
+        def build(dest_repo, wd):
+            with slots:
+                try:
+                    results[dest_repo['local-branch']] = self._create_dest_branch(repo, dest_repo, merge_list, wd,
+                                                                                  config_rr_cache=False)
+                except Exception as e:
+                    self.logger.error("Creating %s branch failed: %s" % (dest_repo['local-branch'], e))
+                    results[dest_repo['local-branch']] = e
+
+        # Started builders are always joined, and worktrees and rr cache are restored, even if the setup fails.
+        try:
+            if rr_cache_params is not None:
+                self._rr_cache_lock.acquire()
+                rr_cache_locked = True
+                self._config_rr_cache(rr_cache_params)
 
-        if upload_options['mode'] == 'force-push':
-            self._git("push", "-f", upload_options['url'], branch_name + ":" + upload_options['branch'])
-        elif upload_options['mode'] == 'push':
-            self._git("push", upload_options['url'], branch_name + ":" + upload_options['branch'])
-        elif upload_options['mode'] == 'refs-for':
-            self._git("push", upload_options['url'], branch_name + ":refs/for/" + upload_options['branch'])
+            for dest_repo in repo['dest-list']:
+                wd = os.path.join(worktree_dir, dest_repo['local-branch'].replace('/', '_'))
+                self._git("branch", "-D", dest_repo['local-branch'], silent=True)
+                worktrees.append(wd)
+                ret, out, err = self.git.add_worktree(wd, dest_repo['local-branch'], repo['repo-head'])
+                if ret != 0:
+                    raise Exception("Creating worktree %s failed. %s" % (wd, err.strip()))
+                worker = threading.Thread(target=build, args=(dest_repo, wd))
+                worker.daemon = True
+                worker.start()
+                workers.append(worker)
+        finally:
+            for worker in workers:
+                # Join with timeout, so that Ctrl-C is delivered to the main thread.
+                while worker.is_alive():
+                    worker.join(1)
+
+            for wd in worktrees:
+                self.git.remove_worktree(wd)
+
+            if rr_cache_locked is True:
+                try:
+                    self._reset_rr_cache(rr_cache_params)
+                finally:
+                    self._rr_cache_lock.release()
+
+        for dest_repo in repo['dest-list']:
+            result = results.get(dest_repo['local-branch'], False)
+            if isinstance(result, Exception):
+                raise result
+            if result is False:
+                return False
+
+        return True
 
-    def _create_branch(self, repo):
+    def _create_branch(self, repo, wd=None):
         """
         Merge the branches given in source-list and create list of output branches as specificed by dest-list option.
         :param repo: Dict with kernel repo options. Check "repo-params" section in kernel integration schema file for
         more details.
-        :return: Nothing
+        :param wd: Work directory (repo directory or worktree) used to create the branches.
+        :return: True if destination branches are created, tested and uploaded, otherwise False.
         """
         self.logger.info(format_h1("Create %s repo", tab=2) % repo['repo-name'])
 
@@ -643,54 +1346,71 @@ class KernelInteg(object):
                 merge_list.append((srepo['url'], srepo['branch']))
 
         # Create destination branches
-        for dest_repo in repo['dest-list']:
-
-            self._git("branch", "-D", dest_repo['local-branch'], silent=True)
-            self._git("checkout", repo['repo-head'], "-b", dest_repo['local-branch'])
+        if self.dest_jobs > 1 and len(repo['dest-list']) > 1:
+            status = self._create_dest_branches_parallel(repo, merge_list)
+        else:
+            for dest_repo in repo['dest-list']:
 
-            if len(merge_list) > 0:
-                self._merge_branches(dest_repo['merge-mode'], merge_list,
-                                     dest_repo['local-branch'],
-                                     dest_repo['merge-options'])
+                self._git("branch", "-D", dest_repo['local-branch'], silent=True, wd=wd)
+                self._git("checkout", repo['repo-head'], "-b", dest_repo['local-branch'], wd=wd)
 
-            if dest_repo['test-branch'] is True:
-                test_options = dest_repo['test-options']
-                status = self._test_branch(dest_repo['local-branch'], test_options)
+                status = self._create_dest_branch(repo, dest_repo, merge_list, wd=wd)
                 if status is False:
-                    self.logger.error("Testing %s branch failed" % dest_repo['local-branch'])
                     break
 
         # Compare destination branches
         if status is True:
             if len(repo['dest-list']) > 1:
+                # Branches are identical if their trees are the same object, diff only to report the difference.
                 base_repo = repo['dest-list'][0]
-                for dest_repo in repo['dest-list']:
-                    ret, out, err = self.git('diff', base_repo, dest_repo)
-                    if ret != 0:
+                base_tree = self.git.rev_parse(base_repo['local-branch'] + '^{tree}')
+                for dest_repo in repo['dest-list'][1:]:
+                    tree = self.git.rev_parse(dest_repo['local-branch'] + '^{tree}')
+                    if base_tree is None or tree is None:
                         status = False
+                        self.logger.error("Invalid destination branch %s or %s" %
+                                          (base_repo['local-branch'], dest_repo['local-branch']))
+                        break
+                    elif tree != base_tree:
+                        status = False
+                        ret, out, err = self.git.cmd('diff', '--stat', base_repo['local-branch'],
+                                                     dest_repo['local-branch'])
+                        self.logger.error("Destination branche %s!=%s" %
+                                          (base_repo['local-branch'], dest_repo['local-branch']))
+                        self.logger.error(out)
                         break
-                    else:
-                        if len(out) > 0:
-                            status = False
-                            self.logger.error("Destination branche %s!=%s" %
-                                              (base_repo['local-branch'], dest_repo['local-branch']))
-                            break
         else:
             self.logger.warn("Skipping destination branch comparison")
 
         # Upload the destination branches
         if status is True:
+            uploads = []
+            inputs = {}
             for dest_repo in repo['dest-list']:
                 if dest_repo['upload-copy'] is True:
                     upload_options = dest_repo['upload-options']
-                    self._upload_branch(dest_repo['local-branch'], upload_options)
+                    inputs[dest_repo['local-branch']] = [self.git.rev_parse(dest_repo['local-branch']), upload_options]
+                    if self.journal.get('upload:' + dest_repo['local-branch'], inputs[dest_repo['local-branch']]) \
+                            is not None:
+                        self.logger.info("Skipping upload of %s, already uploaded" % dest_repo['local-branch'])
+                    else:
+                        uploads.append((dest_repo['local-branch'], upload_options))
 
+            uploaded, failed = self._upload_branches(uploads)
+            for branch_name in uploaded:
+                self.journal.record('upload:' + branch_name, inputs[branch_name], True)
+            if len(failed) > 0:
+                raise Exception("Uploading %s failed" % ', '.join(failed))
+
+            for dest_repo in repo['dest-list']:
                 if dest_repo['generate-output'] is True:
                     output_options = dest_repo['output-options']
                     self._generate_output(repo['repo-head'], dest_repo['local-branch'], output_options)
         else:
             self.logger.warn("Skipping destination branch upload")
 
+        return status
+
     def _get_repo_by_name(self, name):
         """
         Get repo Dict from "repos" list in given Json config file.
@@ -703,19 +1423,61 @@ class KernelInteg(object):
 
         return None
 
-    def _create_branches(self, repo_list=[]):
+    def show_plan(self, kint_branch=None, skip_dep=False):
+        """
+        Get the execution plan of gen_kint_repos().
+        :param kint_branch: Name of the kernel branch.
+        :param skip_dep: Skip creating dependent branches.
+        :return: Plan string.
         """
-        For every repo in repo_list, parse and perform kernel integration as defined by repo options.
+        return self.planner.show_plan(kint_branch, skip_dep)
+
+    def _create_branches(self, repo_list=[], with_deps=False):
+        """
+        Create given repos in dependency order, up to repo_jobs independent repos in parallel. Each repo is created
+        only once per run.
         :param repo_list: List of repos
+        :param with_deps: Also create the repos they depend on.
         :return: None
         """
-        for name in repo_list:
-            repo = self._get_repo_by_name(name)
-            if repo == None:
-                self.logger.error("Repo %s does not exist\n" % name)
-                continue
+        graph, unit = self.planner.plan(repo_list, with_deps)
+        durations = self.planner.load_durations()
+        worktree_dir = os.path.join(self.repo_dir, 'out', 'worktrees')
+
+        self.logger.info(graph.format_plan(unit))
+
+        def create(name):
+            start = time.time()
+            if self.repo_jobs <= 1:
+                status = self._create_branch(self._get_repo_by_name(name))
             else:
-                self._create_branch(repo)
+                wd = os.path.join(worktree_dir, 'repo-' + name)
+                ret, out, err = self.git.add_worktree(wd, None, self._get_repo_by_name(name)['repo-head'])
+                if ret != 0:
+                    raise Exception("Creating worktree %s failed. %s" % (wd, err.strip()))
+                try:
+                    status = self._create_branch(self._get_repo_by_name(name), wd=wd)
+                finally:
+                    self.git.remove_worktree(wd)
+            durations[name] = time.time() - start
+            return status
+
+        results = graph.run(create, self.repo_jobs, done=self._repo_results)
+        self.planner.save_durations(durations)
+
+        # Repos blocked by parked conflicts (and the repos depending on them) are reported at the end of the run.
+        blocked = []
+        for name in graph.topo_order():
+            if isinstance(results[name], MergeConflict):
+                blocked.append(name)
+            elif isinstance(results[name], Exception):
+                if any([dep in blocked for dep in graph.deps[name]]):
+                    blocked.append(name)
+                else:
+                    raise results[name]
+
+        if len(blocked) > 0:
+            self.logger.warn("Repos blocked by merge conflicts: %s" % ', '.join(blocked))
 
     def gen_dep_branches(self, kint_branch):
         """
@@ -725,21 +1487,16 @@ class KernelInteg(object):
         """
         for repo in self.kint_repos:
             if repo['kint-repo'] == kint_branch:
-                self._create_branches(repo['dep-repos'])
+                self._create_branches(repo['dep-repos'], with_deps=True)
 
     def gen_kint_repos(self, kint_branch=None, skip_dep=False):
         """
-        Generate kernel and its depndent branches.
+        Generate kernel and its depndent branches. Repos shared by several kint repos are created only once.
         :param kint_branch: Name of the kernel branch.
         :param skip_dep: Skip creating dependent branches.
         :return: None
         """
-        for repo in self.kint_repos:
-            if kint_branch is not None and repo['kint-repo'] != kint_branch:
-                continue
-            if skip_dep is False:
-                self._create_branches(repo['dep-repos'])
-            self._create_branches([repo['kint-repo']])
+        self._create_branches(self.planner.kint_repo_list(kint_branch), with_deps=skip_dep is False)
 
 def is_valid_dir(parser, arg):
     if not os.path.isdir(arg):
@@ -777,6 +1534,12 @@ def add_cli_options(parser):
     parser.add_argument('--skip-repo-clean', action='store_true', dest='skip_repo_clean',
                         default=False,
                         help='Skip cleaning the the repo')
+    parser.add_argument('--keep-branch', action='append', dest='keep_branches',
+                        default=[],
+                        help='Do not delete branches matching given glob pattern while cleaning the repo')
+    parser.add_argument('--clean-out', action='store_true', dest='clean_out',
+                        default=False,
+                        help='Also delete the out directory while cleaning the repo')
     parser.add_argument('--skip-dep', action='store_true', dest='skip_dep',
                         default=False,
                         help='skip creating dependent repos')
@@ -793,6 +1556,62 @@ def add_cli_options(parser):
                         default='',
                         help='SHA ID or tag of kernel HEAD')
 
+    parser.add_argument('--fetch-jobs', action='store', type=int, dest='fetch_jobs',
+                        default=0,
+                        help='Max number of remotes fetched in parallel (default: all)')
+    parser.add_argument('--git-fetch-jobs', action='store', type=int, dest='git_fetch_jobs',
+                        default=0,
+                        help='Value passed to git fetch --jobs')
+    parser.add_argument('--full-fetch', action='store_true', dest='full_fetch',
+                        default=False,
+                        help='Fetch all branches of remotes, not only the branches used in source lists')
+    parser.add_argument('--mirror-dir', action='store', dest='mirror_dir',
+                        default=None,
+                        help='Shared local mirror repo, repo directory borrows its objects instead of downloading them')
+    parser.add_argument('--fetch-filter', action='store', dest='fetch_filter',
+                        default=None,
+                        help='Partial clone filter used to fetch into repo directory, like blob:none')
+    parser.add_argument('--dest-jobs', action='store', type=int, dest='dest_jobs',
+                        default=1,
+                        help='Max number of destination branches of a repo built in parallel using git worktrees')
+    parser.add_argument('--repo-jobs', action='store', type=int, dest='repo_jobs',
+                        default=1,
+                        help='Max number of independent repos built in parallel using git worktrees')
+    parser.add_argument('--no-integ-cache', action='store_true', dest='no_integ_cache',
+                        default=False,
+                        help='Merge all source branches again, even if they did not change since the last run')
+    parser.add_argument('--resume', action='store_true', dest='resume',
+                        default=False,
+                        help='Skip the steps completed by the previous run, if their inputs did not change')
+    parser.add_argument('--non-interactive', action='store_true', dest='non_interactive',
+                        default=False,
+                        help='Do not wait for manual conflict resolution, block the conflicted branches and report '
+                             'the conflicts at the end of the run')
+    parser.add_argument('--show-plan', action='store_true', dest='show_plan',
+                        default=False,
+                        help='Print the repo dependency plan and critical path estimate, and exit without touching the repo')
+    parser.add_argument('--timeout', action='store', type=int, dest='timeout',
+                        default=None,
+                        help='Abort the integration (kill running commands) after given seconds')
+    parser.add_argument('--cmd-timeout', action='store', type=int, dest='cmd_timeout',
+                        default=None,
+                        help='Kill any single command which runs longer than given seconds')
+    parser.add_argument('--record', action='store', dest='record',
+                        default=None,
+                        help='Record all executed commands and their results in given transcript file')
+    parser.add_argument('--replay', action='store', dest='replay',
+                        default=None,
+                        help='Do not execute any command, serve the results from given transcript file')
+    parser.add_argument('--replay-delay', action='store_true', dest='replay_delay',
+                        default=False,
+                        help='Sleep for the recorded duration of each replayed command')
+    parser.add_argument('--metrics-file', action='store', dest='metrics_file',
+                        default=None,
+                        help='Write per command execution metrics to given file (JSON lines)')
+    parser.add_argument('--trace-file', action='store', dest='trace_file',
+                        default=None,
+                        help='Write per command execution trace to given file (Chrome trace_event format)')
+
     parser.add_argument('config', action='store', help='staging config')
 
 if __name__ == "__main__":
@@ -805,11 +1624,52 @@ if __name__ == "__main__":
 
     args = parser.parse_args()
 
+    if args.show_plan is True:
+        # The plan only needs the config, the repo is not initialized, cleaned or fetched.
+        cfg = load_config(os.path.abspath(args.config), os.path.abspath(args.config_schema), logger=logger)
+        print KintPlan(cfg, args.repo_dir, logger=logger).show_plan(args.kint_repo_name, args.skip_dep)
+        sys.exit(0)
+
+    get_cancel_token().set_timeout(args.timeout)
+    set_cmd_timeout(args.cmd_timeout)
+
+    if args.record is not None:
+        set_transcript(CmdTranscript(args.record, 'record', root=args.repo_dir, logger=logger))
+    elif args.replay is not None:
+        set_transcript(CmdTranscript(args.replay, 'replay', root=args.repo_dir, delay=args.replay_delay,
+                                     logger=logger))
+
     obj = KernelInteg(os.path.abspath(args.config), os.path.abspath(args.config_schema),
                       args.kernel_tag, args.repo_dir,
-                      skip_rr_cache=args.skip_rr_cache, logger=logger)
+                      skip_rr_cache=args.skip_rr_cache,
+                      fetch_jobs=args.fetch_jobs, git_fetch_jobs=args.git_fetch_jobs,
+                      narrow_fetch=not args.full_fetch,
+                      dest_jobs=args.dest_jobs, repo_jobs=args.repo_jobs,
+                      use_integ_cache=not args.no_integ_cache,
+                      resume=args.resume,
+                      interactive=not args.non_interactive,
+                      mirror_dir=args.mirror_dir, fetch_filter=args.fetch_filter,
+                      logger=logger)
 
     if args.skip_repo_clean is False:
-        obj.clean_repo()
+        obj.clean_repo(args.keep_branches, args.clean_out)
 
     obj.gen_kint_repos(args.kint_repo_name, args.skip_dep)
+
+    if args.resume is True:
+        logger.info("Reused %d steps from run journal" % len(obj.journal.reused))
+
+    report = obj.conflict_report()
+    if len(report) > 0:
+        logger.warn(report)
+        obj.send_email(subject='Merge Conflict Report', content=report)
+
+    logger.info("git query cache: %(hits)d hits, %(misses)d misses" % obj.git.query_cache.stats())
+
+    tracer = get_tracer()
+    for name, (count, wall, cpu) in sorted(tracer.summary().items(), key=lambda it: it[1][1], reverse=True):
+        logger.info("%-32s: %5d runs, wall %9.2fs, cpu %9.2fs" % (name, count, wall, cpu))
+    if args.metrics_file is not None:
+        tracer.dump_jsonl(args.metrics_file)
+    if args.trace_file is not None:
+        tracer.dump_chrome_trace(args.trace_file)
@@ -225,14 +225,14 @@ class BuildKernel(object):
                 self._make_target(target=target, flags=flags, log=log, dryrun=dryrun)
             setattr(self.__class__, 'make_' + target , make_variant)
 
-    def _exec_cmd(self, cmd, log=False, dryrun=False):
+    def _exec_cmd(self, cmd, log=False, dryrun=False, spool=False):
         self.logger.debug("BuildKernel: Executing %s", ' '.join(map(lambda x: str(x), cmd)))
 
         shell = PyShell(logger=self.logger)
 
-        return shell.cmd(*cmd, out_log=log, dry_run=dryrun)
+        return shell.cmd(*cmd, out_log=log, dry_run=dryrun, spool=spool)
 
-    def _make_target(self, target=None, flags=[], log=False, dryrun=False):
+    def _make_target(self, target=None, flags=[], log=False, dryrun=False, spool=False):
 
         mkcmd = [MAKE_CMD] + self.clags + ['-j%d' % self.threads, "ARCH=%s" % self.arch, "O=%s" % self.out, "-C", self.src]
 
@@ -248,11 +248,12 @@ class BuildKernel(object):
         if target is not None:
             mkcmd.append(target)
 
-        ret, out, err = self._exec_cmd(mkcmd, log=log, dryrun=dryrun)
+        ret, out, err = self._exec_cmd(mkcmd, log=log, dryrun=dryrun, spool=spool)
         if ret != 0:
             self.logger.error(' '.join(mkcmd) + " Command failed")
 
-        self.logger.debug(out)
+        # Spooled output can be hundreds of MB, only log the tail of it.
+        self.logger.debug(out.tail() if spool is True else out)
 
         return ret, out, err
 
@@ -261,9 +262,15 @@ class BuildKernel(object):
         copy(cfg, self.cfg)
         self._make_target(target='oldconfig', flags=flags, log=log, dryrun=dryrun)
 
-    def make_kernel(self, flags=[], log=False, dryrun=False):
+    def make_kernel(self, flags=[], log=False, dryrun=False, spool=False):
+        """
+        Build the kernel.
+        :param spool: Set True to keep the build output in OutputSpool objects (bounded memory, spilled to disk)
+                      instead of strings.
+        :return: (ret, out, err) tuple.
+        """
         assert_exists(self.cfg, "No config file found in %s" % self.cfg, logger=self.logger)
-        return self._make_target(flags=flags, log=log, dryrun=dryrun)
+        return self._make_target(flags=flags, log=log, dryrun=dryrun, spool=spool)
 
     def merge_config(self, diff_cfg, dryrun=False):
         kobj = KernelConfig(self.cfg, logger=self.logger)
@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+#
+# Command record/replay transcripts
+#
+# Copyright (C) 2018 Sathya Kuppuswamy
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# @Author  : Sathya Kupppuswamy(sathyaosid@gmail.com)
+# @History :
+#            @v0.0 - Basic class support
+# @TODO    :
+#
+#
+
+import json
+import logging
+from collections import deque
+
+ROOT_TAG = '${ROOT}'
+
+# Command output is arbitrary bytes (binary diffs, latin-1 patches), it is stored as latin-1 decoded text which maps
+# every byte to one code point and back.
+ENCODING = 'latin-1'
+
+def _to_text(value):
+    return str(value).decode(ENCODING)
+
+def _to_bytes(value, encoding):
+    return value.encode(encoding)
+
+class CmdTranscript(object):
+    """
+    Transcript of executed commands. In record mode, argv, work dir, exit code, output and duration of every command
+    executed through PyShell are appended to a JSON lines file. In replay mode, the recorded results are served back
+    without executing anything, optionally sleeping for the recorded duration, which allows benchmarking the
+    orchestration logic without a kernel tree, remotes or tool chains.
+
+    Paths under root are stored relative to it, so a transcript recorded in one work dir can be replayed in another.
+    """
+    def __init__(self, path, mode='record', root=None, delay=False, logger=None):
+        """
+        :param path: Transcript file name.
+        :param mode: "record" or "replay".
+        :param root: Work dir root, replaced with ${ROOT} in the stored argv/work dir.
+        :param delay: Set True to replay recorded durations.
+        :param logger: Logger object.
+        """
+        self.logger = logger or logging.getLogger(__name__)
+        self.path = path
+        self.mode = mode
+        self.root = root.rstrip('/') if root else None
+        self.delay = delay
+        self.entries = {}
+        self.misses = 0
+        self._fobj = None
+
+        if mode == 'record':
+            self._fobj = open(path, 'w+')
+        elif mode == 'replay':
+            self._load()
+        else:
+            raise Exception("Invalid transcript mode %s" % mode)
+
+    def _norm(self, value):
+        value = str(value)
+        if self.root is not None:
+            value = value.replace(self.root, ROOT_TAG)
+
+        return value
+
+    def _key(self, args, wd):
+        return tuple(map(self._norm, args)), self._norm(wd)
+
+    def _load(self):
+        with open(self.path) as fobj:
+            for line in fobj:
+                if len(line.strip()) == 0:
+                    continue
+                entry = json.loads(line)
+                # Transcripts without an encoding field were written as plain (UTF-8) JSON strings.
+                encoding = entry.get("encoding", 'utf-8')
+                for name in ("out", "err", "cwd"):
+                    entry[name] = _to_bytes(entry[name], encoding)
+                entry["argv"] = [_to_bytes(arg, encoding) for arg in entry["argv"]]
+                key = (tuple(entry["argv"]), entry["cwd"])
+                self.entries.setdefault(key, deque()).append(entry)
+
+        self.logger.debug("Loaded %d commands from transcript %s", sum(map(len, self.entries.values())), self.path)
+
+    def recording(self):
+        return self.mode == 'record'
+
+    def replaying(self):
+        return self.mode == 'replay'
+
+    def record(self, args, wd, ret, out, err, duration):
+        """
+        Append the result of a command to the transcript.
+        """
+        if not self.recording():
+            return
+
+        key = self._key(args, wd)
+        entry = {"argv": map(_to_text, key[0]), "cwd": _to_text(key[1]), "ret": ret, "out": _to_text(out),
+                 "err": _to_text(err), "duration": duration, "encoding": ENCODING}
+        self._fobj.write(json.dumps(entry, sort_keys=True) + '\n')
+        self._fobj.flush()
+
+    def replay(self, args, wd):
+        """
+        Get the recorded result of a command. Results of a repeated command are served in recorded order, and the
+        last one keeps being served once they are used up.
+        :return: (ret, out, err, duration) tuple or None if the command is not in the transcript.
+        """
+        queue = self.entries.get(self._key(args, wd), None)
+        if queue is None:
+            self.misses += 1
+            return None
+
+        entry = queue.popleft() if len(queue) > 1 else queue[0]
+
+        return entry["ret"], entry["out"], entry["err"], entry["duration"] if self.delay else 0
+
+    def close(self):
+        if self._fobj is not None:
+            self._fobj.close()
+            self._fobj = None
+
+_transcript = None
+
+def get_transcript():
+    """
+    :return: Process wide CmdTranscript or None if record/replay is not enabled.
+    """
+    return _transcript
+
+def set_transcript(transcript):
+    global _transcript
+    _transcript = transcript
@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+#
+# Command execution telemetry
+#
+# Copyright (C) 2018 Sathya Kuppuswamy
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# @Author  : Sathya Kupppuswamy(sathyaosid@gmail.com)
+# @History :
+#            @v0.0 - Basic class support
+# @TODO    :
+#
+#
+
+import os
+import json
+import time
+import logging
+import resource
+
+class CmdTracer(object):
+    """
+    Collects execution metrics of every command executed through PyShell, and exports them as JSON lines or as a
+    Chrome trace_event file (load it in chrome://tracing or https://ui.perfetto.dev).
+
+    CPU time and max RSS come from getrusage(RUSAGE_CHILDREN). CPU time is the delta between start and end of the
+    command, so it is exact for serial commands, but includes other children reaped in between when commands run
+    concurrently. max RSS is the largest RSS of any child reaped so far.
+    """
+    def __init__(self, logger=None):
+        self.logger = logger or logging.getLogger(__name__)
+        self.records = []
+        self.enabled = True
+
+    def start(self, args, wd):
+        """
+        Mark the start of a command.
+        :param args: Command argv.
+        :param wd: Work directory of the command.
+        :return: Opaque start context, to be passed to end().
+        """
+        if not self.enabled:
+            return None
+
+        return list(args), wd, time.time(), resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    def end(self, context, ret, out_bytes=0, err_bytes=0):
+        """
+        Mark the end of a command and store its record.
+        :param context: Return value of start().
+        :param ret: Exit code of the command.
+        :param out_bytes: Size of stdout.
+        :param err_bytes: Size of stderr.
+        :return: Record dict, or None if tracing is disabled.
+        """
+        if context is None:
+            return None
+
+        args, wd, start, ru_start = context
+        end = time.time()
+        ru_end = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+        record = {
+            "argv": args,
+            "cwd": wd,
+            "start": start,
+            "wall": end - start,
+            "utime": ru_end.ru_utime - ru_start.ru_utime,
+            "stime": ru_end.ru_stime - ru_start.ru_stime,
+            "maxrss_kb": ru_end.ru_maxrss,
+            "out_bytes": out_bytes,
+            "err_bytes": err_bytes,
+            "ret": ret
+        }
+
+        self.records.append(record)
+
+        return record
+
+    def clear(self):
+        self.records = []
+
+    def _name(self, record):
+        # Shell command lines are stored as a single string.
+        argv = ' '.join(record["argv"]).split()
+        if len(argv) == 0:
+            return ''
+        name = os.path.basename(argv[0])
+        if len(argv) > 1 and not argv[1].startswith('-'):
+            name += ' ' + argv[1]
+
+        return name
+
+    def summary(self):
+        """
+        :return: Dict of command name -> (count, total wall time, total cpu time).
+        """
+        result = {}
+        for record in self.records:
+            name = self._name(record)
+            count, wall, cpu = result.get(name, (0, 0.0, 0.0))
+            result[name] = (count + 1, wall + record["wall"], cpu + record["utime"] + record["stime"])
+
+        return result
+
+    def dump_jsonl(self, outfile):
+        """
+        Write one JSON record per line.
+        :param outfile: Output file name.
+        """
+        with open(outfile, 'w+') as fobj:
+            for record in self.records:
+                fobj.write(json.dumps(record, sort_keys=True) + '\n')
+
+    def dump_chrome_trace(self, outfile):
+        """
+        Write the records as complete ("X") events of Chrome trace_event format. Overlapping commands are placed on
+        separate lanes (tid).
+        :param outfile: Output file name.
+        """
+        events = []
+        lanes = []
+        pid = os.getpid()
+
+        for record in sorted(self.records, key=lambda r: r["start"]):
+            lane = 0
+            while lane < len(lanes) and lanes[lane] > record["start"]:
+                lane += 1
+            if lane == len(lanes):
+                lanes.append(0)
+            lanes[lane] = record["start"] + record["wall"]
+
+            events.append({
+                "name": self._name(record),
+                "cat": os.path.basename(' '.join(record["argv"]).split()[0]) if len(record["argv"]) > 0 else '',
+                "ph": "X",
+                "ts": int(record["start"] * 1000000),
+                "dur": int(record["wall"] * 1000000),
+                "pid": pid,
+                "tid": lane,
+                "args": {
+                    "argv": ' '.join(record["argv"]),
+                    "cwd": record["cwd"],
+                    "ret": record["ret"],
+                    "utime": record["utime"],
+                    "stime": record["stime"],
+                    "maxrss_kb": record["maxrss_kb"],
+                    "out_bytes": record["out_bytes"],
+                    "err_bytes": record["err_bytes"]
+                }
+            })
+
+        with open(outfile, 'w+') as fobj:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, fobj)
+
+_default_tracer = None
+
+def get_tracer():
+    """
+    :return: Process wide default CmdTracer, shared by all PyShell objects.
+    """
+    global _default_tracer
+    if _default_tracer is None:
+        _default_tracer = CmdTracer()
+
+    return _default_tracer
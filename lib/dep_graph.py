@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+#
+# Dependency graph and parallel scheduler
+#
+# Copyright (C) 2018 Sathya Kuppuswamy
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# @Author  : Sathya Kupppuswamy(sathyaosid@gmail.com)
+# @History :
+#            @v0.0 - Basic class support
+# @TODO    :
+#
+#
+
+import logging
+import threading
+from Queue import Queue, Empty
+
+class DepGraph(object):
+    """
+    Directed acyclic graph of named jobs. Each node has an estimated cost, and an edge from a node to one of its
+    dependencies means the node can only run once the dependency is done.
+    """
+    def __init__(self, logger=None):
+        self.logger = logger or logging.getLogger(__name__)
+        self.nodes = []
+        self.costs = {}
+        self.deps = {}
+
+    def add_node(self, name, cost=1):
+        if name not in self.costs:
+            self.nodes.append(name)
+            self.deps[name] = []
+        self.costs[name] = cost
+
+    def add_edge(self, name, dep):
+        """
+        Make node name depend on node dep. Missing nodes are added with default cost.
+        """
+        if name == dep:
+            return
+        for node in (name, dep):
+            if node not in self.costs:
+                self.add_node(node)
+        if dep not in self.deps[name]:
+            self.deps[name].append(dep)
+
+    def subgraph(self, names, with_deps=True):
+        """
+        :param names: List of node names.
+        :param with_deps: Set True to include all (direct and indirect) dependencies of given nodes.
+        :return: New DepGraph with the selected nodes.
+        """
+        selected = []
+        stack = list(reversed(names))
+        while len(stack) > 0:
+            name = stack.pop()
+            if name in selected or name not in self.costs:
+                continue
+            selected.append(name)
+            if with_deps is True:
+                stack += self.deps[name]
+
+        graph = DepGraph(logger=self.logger)
+        for name in self.nodes:
+            if name in selected:
+                graph.add_node(name, self.costs[name])
+        for name in graph.nodes:
+            for dep in self.deps[name]:
+                if dep in selected:
+                    graph.add_edge(name, dep)
+
+        return graph
+
+    def topo_order(self):
+        """
+        :return: List of node names, every node is placed after its dependencies. Ties keep the insertion order.
+        """
+        order = []
+        state = {}
+
+        def visit(name, path):
+            if state.get(name) == 'done':
+                return
+            if state.get(name) == 'visiting':
+                raise Exception("Dependency cycle %s" % ' -> '.join(path + [name]))
+            state[name] = 'visiting'
+            for dep in self.deps[name]:
+                visit(dep, path + [name])
+            state[name] = 'done'
+            order.append(name)
+
+        for name in self.nodes:
+            visit(name, [])
+
+        return order
+
+    def levels(self):
+        """
+        :return: List of levels, each one a list of nodes which only depend on nodes of previous levels.
+        """
+        level = {}
+        for name in self.topo_order():
+            level[name] = max([level[dep] + 1 for dep in self.deps[name]] or [0])
+
+        result = [[] for i in range(0, max(level.values() or [-1]) + 1)]
+        for name in self.nodes:
+            result[level[name]].append(name)
+
+        return result
+
+    def critical_path(self):
+        """
+        :return: (path, cost) tuple of the most expensive dependency chain. It is the lower bound of the run time with
+        unlimited parallelism.
+        """
+        finish = {}
+        prev = {}
+        for name in self.topo_order():
+            start = 0
+            prev[name] = None
+            for dep in self.deps[name]:
+                if finish[dep] > start:
+                    start, prev[name] = finish[dep], dep
+            finish[name] = start + self.costs[name]
+
+        if len(finish) == 0:
+            return [], 0
+
+        name = max(self.nodes, key=lambda it: finish[it])
+        cost = finish[name]
+        path = []
+        while name is not None:
+            path.insert(0, name)
+            name = prev[name]
+
+        return path, cost
+
+    def format_plan(self, unit=''):
+        """
+        :param unit: Unit of node costs, used in the output.
+        :return: Printable execution plan.
+        """
+        out = 'Execution plan:\n'
+        for index, level in enumerate(self.levels()):
+            out += '\tStage %d:\n' % index
+            for name in level:
+                deps = ', '.join(self.deps[name]) if len(self.deps[name]) > 0 else '-'
+                out += '\t\t%-32s cost: %8.1f%s deps: %s\n' % (name, self.costs[name], unit, deps)
+
+        path, cost = self.critical_path()
+        out += '\tSerial cost   : %.1f%s\n' % (sum(self.costs.values()), unit)
+        out += '\tCritical path : %s (%.1f%s)\n' % (' -> '.join(path), cost, unit)
+
+        return out
+
+    def run(self, func, jobs=1, done=None):
+        """
+        Execute func(name) for every node, running up to jobs nodes in parallel threads. A node is started once all
+        its dependencies are done. Dependents of a node which raised an exception are not executed.
+        :param func: Function to run for each node.
+        :param jobs: Max number of parallel nodes.
+        :param done: Dict of name -> result of already executed nodes, updated in place. Nodes in it are not run
+        again.
+        :return: Dict of name -> result (return value, or the exception raised by func) of all nodes.
+        """
+        done = done if done is not None else {}
+        order = self.topo_order()
+        pending = [name for name in order if name not in done]
+        events = Queue()
+        running = 0
+
+        def worker(name):
+            try:
+                result = func(name)
+            except Exception as e:
+                self.logger.error("%s failed: %s" % (name, e))
+                result = e
+            events.put((name, result))
+
+        def failed(name):
+            return isinstance(done.get(name), BaseException)
+
+        while len(pending) > 0 or running > 0:
+            for name in list(pending):
+                if running >= max(jobs, 1):
+                    break
+                if any([dep not in done for dep in self.deps[name]]):
+                    continue
+                pending.remove(name)
+                if any(map(failed, self.deps[name])):
+                    done[name] = Exception("Skipped %s, dependency failed" % name)
+                    continue
+                thread = threading.Thread(target=worker, args=(name,))
+                thread.daemon = True
+                thread.start()
+                running += 1
+
+            if running == 0:
+                continue
+
+            # Timeout allows Ctrl-C to interrupt the wait.
+            while True:
+                try:
+                    name, result = events.get(True, 1)
+                    break
+                except Empty:
+                    continue
+            done[name] = result
+            running -= 1
+
+        return dict([(name, done[name]) for name in order])
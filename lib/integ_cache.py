@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+#
+# Incremental integration cache
+#
+# Copyright (C) 2018 Sathya Kuppuswamy
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# @Author  : Sathya Kupppuswamy(sathyaosid@gmail.com)
+# @History :
+#            @v0.0 - Basic class support
+# @TODO    :
+#
+#
+
+import os
+import json
+import hashlib
+import logging
+import threading
+
+CACHE_REF_PREFIX = 'refs/kint-cache/'
+
+class IntegCache(object):
+    """
+    Cache of merge results. For every destination branch, the commit created after each merge step is stored along
+    with the key of all inputs up to that step (repo head, merge options and the ordered list of merged source tips).
+    When a branch is created again, the longest prefix of steps with unchanged inputs is reused, and only the
+    remaining sources are merged.
+
+    Step keys are stored in <git common dir>/kint-cache.json, and the last result of each branch is kept alive by a
+    ref under refs/kint-cache/ (earlier steps are its ancestors).
+    """
+    def __init__(self, git, repo_dir, persist=True, logger=None):
+        """
+        :param git: GitShell object of the repo.
+        :param repo_dir: Repo directory.
+        :param persist: Set False to keep the cache in memory only, the cache file is neither read nor written.
+        :param logger: Logger object.
+        """
+        self.logger = logger or logging.getLogger(__name__)
+        self.git = git
+        self.repo_dir = repo_dir
+        common_dir = self.git.cmd('rev-parse', '--git-common-dir', wd=repo_dir)[1].strip() or '.git'
+        self.path = os.path.join(repo_dir, common_dir, 'kint-cache.json')
+        self.entries = {}
+        self.persist = persist
+        self._lock = threading.Lock()
+        self._load()
+
+    def _load(self):
+        if self.persist is False or not os.path.exists(self.path):
+            return
+
+        try:
+            with open(self.path) as fobj:
+                self.entries = json.load(fobj)
+        except ValueError:
+            self.logger.warn("Ignoring invalid integration cache %s" % self.path)
+            self.entries = {}
+
+    def _save(self):
+        if self.persist is False:
+            return
+
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w+') as fobj:
+            json.dump(self.entries, fobj, indent=4, sort_keys=True)
+        os.rename(tmp_path, self.path)
+
+    def keys(self, head, options, tips):
+        """
+        Get the key of each merge step.
+        :param head: SHA ID of the base of the branch.
+        :param options: Dict of merge options which change the result.
+        :param tips: Ordered list of (ref, SHA ID) tuple of merged sources.
+        :return: List of keys, key i covers the inputs of merge steps 0..i.
+        """
+        digest = hashlib.sha1(json.dumps([head, options], sort_keys=True))
+        keys = []
+        for ref, sha in tips:
+            digest.update('\n%s %s' % (ref, sha))
+            keys.append(digest.hexdigest())
+
+        return keys
+
+    def lookup(self, branch, keys):
+        """
+        Find the longest prefix of merge steps which can be reused.
+        :param branch: Destination branch name.
+        :param keys: Keys of the merge steps (see keys()).
+        :return: (number of reusable steps, SHA ID of the commit after the last of them) tuple, (0, None) if nothing
+        can be reused.
+        """
+        steps = self.entries.get(branch, [])
+        matches = []
+
+        for index, key in enumerate(keys):
+            if index >= len(steps) or steps[index][0] != key:
+                break
+            if steps[index][1] is not None:
+                matches.append((index + 1, steps[index][1]))
+
+        # Objects might be gone (repo re-cloned or gc after the cache ref was deleted).
+        for count, sha in reversed(matches):
+            if self.git.is_valid_ref(sha + '^{commit}', wd=self.repo_dir) is True:
+                return count, sha
+
+        return 0, None
+
+    def store(self, branch, keys, shas):
+        """
+        Store the result of the merge steps of a branch.
+        :param branch: Destination branch name.
+        :param keys: Keys of the merge steps.
+        :param shas: SHA ID of the commit after each merge step, None if not known (intermediate steps of an octopus
+        merge).
+        :return: None
+        """
+        steps = [[key, sha] for key, sha in zip(keys, shas)]
+        known = [sha for sha in shas if sha is not None]
+
+        with self._lock:
+            self.entries[branch] = steps
+            self._save()
+            if len(known) > 0:
+                self.git.cmd('update-ref', CACHE_REF_PREFIX + branch, known[-1], wd=self.repo_dir)
+            else:
+                self.git.cmd('update-ref', '-d', CACHE_REF_PREFIX + branch, wd=self.repo_dir)
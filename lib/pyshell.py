@@ -1,97 +1,813 @@
 #!/usr/bin/env python
 
 import os
+import errno
+import fcntl
+import time
+import signal
+import select
 import logging
+import multiprocessing
+import threading
+import tempfile
+from collections import deque
 from subprocess import Popen, PIPE
-from threading import Thread
-from Queue import Queue, Empty
+from cmd_trace import get_tracer
+from cmd_replay import get_transcript
 
 GIT_COMMAND_PATH='/usr/bin/git'
 
+# Seconds to wait after SIGTERM before a killed command gets SIGKILL.
+KILL_GRACE = 2.0
+
+# Default limits of spooled command output.
+SPOOL_MAX_MEM = 4 * 1024 * 1024
+SPOOL_MAX_TAIL = 64 * 1024
+
+class OutputSpool(object):
+    """
+    Bounded memory store for command output. Output is kept in memory until it grows beyond max_mem bytes, after
+    that the whole output is spilled to an anonymous temp file and only the last max_tail bytes are kept in memory.
+    """
+    def __init__(self, max_mem=SPOOL_MAX_MEM, max_tail=SPOOL_MAX_TAIL, tmp_dir=None):
+        self.max_mem = max_mem
+        self.max_tail = max_tail
+        self.tmp_dir = tmp_dir
+        self.size = 0
+        self._chunks = []
+        self._tail_size = 0
+        self._file = None
+
+    def _trim_tail(self):
+        while len(self._chunks) > 1 and self._tail_size - len(self._chunks[0]) >= self.max_tail:
+            self._tail_size -= len(self._chunks.pop(0))
+
+    def append(self, data):
+        if len(data) == 0:
+            return
+
+        self.size += len(data)
+        self._chunks.append(data)
+        self._tail_size += len(data)
+
+        if self._file is None:
+            if self.size <= self.max_mem:
+                return
+            self._file = tempfile.TemporaryFile(dir=self.tmp_dir)
+            for chunk in self._chunks:
+                self._file.write(chunk)
+        else:
+            self._file.write(data)
+
+        self._trim_tail()
+
+    def spilled(self):
+        return self._file is not None
+
+    def tail(self, size=None):
+        """
+        :param size: Max number of bytes to return, defaults to max_tail.
+        :return: Last bytes of the output.
+        """
+        size = self.max_tail if size is None else size
+        data = ''.join(self._chunks)
+
+        return data[-size:] if size > 0 else ''
+
+    def chunks(self, chunk_size=65536):
+        """
+        Iterate over the whole output without loading it into memory.
+        """
+        if self._file is None:
+            for chunk in self._chunks:
+                yield chunk
+            return
+
+        self._file.flush()
+        self._file.seek(0)
+        while True:
+            chunk = self._file.read(chunk_size)
+            if len(chunk) == 0:
+                break
+            yield chunk
+        self._file.seek(0, os.SEEK_END)
+
+    def lines(self):
+        """
+        Iterate over the output lines (with line endings) without loading the whole output into memory.
+        """
+        partial = ''
+        for chunk in self.chunks():
+            lines = (partial + chunk).split('\n')
+            partial = lines.pop()
+            for line in lines:
+                yield line + '\n'
+
+        if len(partial) > 0:
+            yield partial
+
+    def read(self):
+        return ''.join(self.chunks())
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        self._chunks = []
+        self._tail_size = 0
+
+    def __len__(self):
+        return self.size
+
+    def __str__(self):
+        return self.read()
+
+class CancelToken(object):
+    """
+    Cancellation flag shared by a set of commands, with an optional deadline. Commands executed with a token are
+    killed (along with their process group) as soon as the token is cancelled or its deadline expires.
+    """
+    def __init__(self, timeout=None):
+        self.deadline = None
+        self.reason = None
+        self.set_timeout(timeout)
+
+    def set_timeout(self, timeout):
+        """
+        :param timeout: Seconds from now after which the token is cancelled. None to clear the deadline.
+        """
+        self.deadline = time.time() + timeout if timeout is not None else None
+
+    def cancel(self, reason='Command cancelled'):
+        if self.reason is None:
+            self.reason = reason
+
+    def cancelled(self):
+        if self.reason is None and self.deadline is not None and time.time() >= self.deadline:
+            self.reason = 'Global deadline expired'
+
+        return self.reason is not None
+
+_global_cancel = CancelToken()
+_default_cmd_timeout = None
+
+def get_cancel_token():
+    """
+    :return: Process wide CancelToken used by commands which are not given their own token. Use its set_timeout()
+             for a global deadline.
+    """
+    return _global_cancel
+
+def set_cmd_timeout(timeout):
+    """
+    Set default per command timeout (in seconds) for all shells. None disables it.
+    """
+    global _default_cmd_timeout
+    _default_cmd_timeout = timeout
+
+class Poller(object):
+    """
+    Thin wrapper around poll(), falling back to select() on platforms without poll support.
+    """
+    def __init__(self):
+        self._poll = select.poll() if hasattr(select, 'poll') else None
+        self._fds = set()
+
+    def register(self, fd):
+        if self._poll is not None:
+            self._poll.register(fd, select.POLLIN | select.POLLPRI | select.POLLHUP | select.POLLERR)
+        self._fds.add(fd)
+
+    def unregister(self, fd):
+        if fd not in self._fds:
+            return
+        if self._poll is not None:
+            self._poll.unregister(fd)
+        self._fds.discard(fd)
+
+    def poll(self, timeout):
+        """
+        Wait for pipe activity.
+        :param timeout: Timeout in seconds.
+        :return: List of readable (or hung up) file descriptors. Empty list on timeout.
+        """
+        try:
+            if self._poll is not None:
+                return [fd for fd, event in self._poll.poll(int(timeout * 1000))]
+            return select.select(list(self._fds), [], [], timeout)[0]
+        except (select.error, IOError, OSError) as e:
+            if e.args[0] == errno.EINTR:
+                return []
+            raise
+
+class StreamCapture(object):
+    """
+    Single threaded output capture engine. Reads stdout and stderr pipes of a child process without blocking, using
+    poll() (or select() where poll is not available), and dispatches every complete line to the given callbacks.
+    """
+    def __init__(self, process, line_cb=None, sinks=None, chunk_size=65536, poll_timeout=0.1,
+                 deadline=None, cancel=None, kill_group=False):
+        """
+        :param process: Popen object created with stdout=PIPE and stderr=PIPE.
+        :param line_cb: List of callbacks, called as cb(identifier, line) for every output line. identifier is
+                        either "STDOUT" or "STDERR".
+        :param sinks: Tuple of (stdout, stderr) objects which store the output, any object with an append() method
+                      works. Defaults to lists of output chunks.
+        :param chunk_size: Max bytes read from a pipe in one go.
+        :param poll_timeout: Seconds to wait for pipe activity before checking whether the child has exited.
+        :param deadline: Absolute time (time.time()) after which the child is killed.
+        :param cancel: CancelToken, the child is killed when its cancelled.
+        :param kill_group: Set True if the child leads its own process group, to kill the whole group.
+        """
+        self.process = process
+        self.line_cb = line_cb or []
+        self.chunk_size = chunk_size
+        self.poll_timeout = poll_timeout
+        self.output, self.error = sinks if sinks is not None else (list(), list())
+        self.deadline = deadline
+        self.cancel = cancel
+        self.kill_group = kill_group
+        self.killed = None
+        self._kill_time = None
+        self._streams = {}
+        self._partial = {}
+
+        for identifier, stream, data in (('STDOUT', process.stdout, self.output),
+                                         ('STDERR', process.stderr, self.error)):
+            if stream is not None:
+                self._streams[stream.fileno()] = (identifier, stream, data)
+                self._partial[identifier] = ''
+
+    def _dispatch(self, identifier, chunk):
+        if len(self.line_cb) == 0:
+            return
+
+        lines = (self._partial[identifier] + chunk).split('\n')
+        self._partial[identifier] = lines.pop()
+        for line in lines:
+            for cb in self.line_cb:
+                cb(identifier, line + '\n')
+
+    def _read(self, fd):
+        identifier, stream, data = self._streams[fd]
+        try:
+            chunk = os.read(fd, self.chunk_size)
+        except OSError as e:
+            if e.errno in (errno.EAGAIN, errno.EINTR):
+                return True
+            raise
+
+        if len(chunk) == 0:
+            return False
+
+        data.append(chunk)
+        self._dispatch(identifier, chunk)
+
+        return True
+
+    def _drain(self, fd):
+        """
+        Read what is left in given pipe without blocking, up to end of file or until it is empty (a grand child
+        which inherited the pipe may still keep it open).
+        """
+        identifier, stream, data = self._streams[fd]
+        fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        while True:
+            try:
+                chunk = os.read(fd, self.chunk_size)
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                if e.errno == errno.EAGAIN:
+                    return
+                raise
+            if len(chunk) == 0:
+                return
+            data.append(chunk)
+            self._dispatch(identifier, chunk)
+
+    def _close(self, fd):
+        identifier, stream, data = self._streams.pop(fd)
+        if len(self._partial[identifier]) > 0:
+            for cb in self.line_cb:
+                cb(identifier, self._partial[identifier])
+            self._partial[identifier] = ''
+        if not stream.closed:
+            stream.close()
+
+    def _signal(self, sig):
+        try:
+            if self.kill_group:
+                os.killpg(self.process.pid, sig)
+            elif self.process.returncode is None:
+                os.kill(self.process.pid, sig)
+        except OSError:
+            pass
+
+    def kill(self, reason):
+        """
+        Terminate the child, or its process group. It gets SIGKILL if its still alive KILL_GRACE seconds later.
+        :param reason: Message appended to stderr of the command.
+        """
+        if self.killed is not None:
+            return
+
+        self.killed = reason
+        self._kill_time = time.time()
+        self._signal(signal.SIGTERM)
+
+    def check(self):
+        """
+        Enforce the deadline and cancellation token.
+        """
+        if self.killed is None:
+            if self.deadline is not None and time.time() >= self.deadline:
+                self.kill('Command timed out')
+            elif self.cancel is not None and self.cancel.cancelled():
+                self.kill(self.cancel.reason)
+        elif self._kill_time is not None and time.time() - self._kill_time >= KILL_GRACE:
+            self._signal(signal.SIGKILL)
+            self._kill_time = None
+
+    def fds(self):
+        """
+        :return: List of pipe file descriptors which are still open.
+        """
+        return list(self._streams.keys())
+
+    def done(self):
+        return len(self._streams) == 0
+
+    def handle(self, fd):
+        """
+        Read the available data from given pipe.
+        :param fd: Readable file descriptor returned by poll.
+        :return: False if the pipe is closed, otherwise True.
+        """
+        if fd not in self._streams:
+            return False
+
+        if self._read(fd) is False:
+            self._close(fd)
+            return False
+
+        return True
+
+    def finish(self):
+        """
+        Read what is left in the remaining pipes, close them and reap the child.
+        :return: Tuple of stdout and stderr sinks.
+        """
+        for fd in self.fds():
+            self._drain(fd)
+            self._close(fd)
+
+        self.process.wait()
+
+        if self.killed is not None:
+            self.error.append('\n' + self.killed + '\n')
+
+        return self.output, self.error
+
+    def run(self):
+        """
+        Capture the output until both pipes are closed, or the child exits and nothing is left to read (which happens
+        when a grand child inherits the pipes and keeps them open).
+        :return: Tuple of stdout and stderr sinks.
+        """
+        poller = Poller()
+        for fd in self.fds():
+            poller.register(fd)
+
+        try:
+            while not self.done():
+                self.check()
+                ready = poller.poll(self.poll_timeout)
+
+                if len(ready) == 0:
+                    if self.process.poll() is not None:
+                        break
+                    continue
+
+                for fd in ready:
+                    if self.handle(fd) is False:
+                        poller.unregister(fd)
+        except BaseException:
+            # Children in their own process group do not get the terminal signals, don't leave them behind.
+            self._signal(signal.SIGKILL)
+            raise
+
+        return self.finish()
+
+class CmdFuture(object):
+    """
+    Result handle of a command submitted to CmdLoop.
+    """
+    def __init__(self, loop, shell, args, kwargs):
+        self.loop = loop
+        self.shell = shell
+        self.args = args
+        self.wd = kwargs.get('wd', shell.wd)
+        self.out_log = kwargs.get('out_log', False)
+        self.dry_run = kwargs.get('dry_run', False)
+        self.use_shell = kwargs.get('shell', False)
+        self.line_cb = kwargs.get('line_cb', None)
+        self.spool = kwargs.get('spool', False)
+        self.timeout = kwargs.get('timeout', None)
+        self.cancel_token = kwargs.get('cancel', None)
+        self.input = kwargs.get('input', None)
+        self.process = None
+        self.capture = None
+        self.ready_at = None
+        self.start_time = None
+        self.end_time = None
+        self._replayed = None
+        self._result = None
+
+    def _start(self):
+        self.start_time = time.time()
+        deadline, cancel = self.shell._limits(self.timeout, self.cancel_token)[:2]
+        if cancel.cancelled():
+            self._result = self.shell._cancelled_result(self.args, self.spool, cancel.reason)
+            return
+
+        replay = self.shell._replay(self.args, self.wd, self.dry_run, self.spool)
+        if replay is not None:
+            self._replayed, duration = replay
+            self.ready_at = time.time() + duration
+            if duration <= 0:
+                self._result = self._replayed
+            return
+
+        # Loop commands can be cancelled at any time (fail fast), so they always lead their own process group, and
+        # cancelling them kills their children too.
+        self.process = self.shell._start(self.args, self.wd, self.dry_run, self.use_shell, group=True,
+                                         input=self.input)
+        if self.process is None:
+            self._result = self.shell._dry_result(self.spool)
+            return
+
+        if self.input is not None:
+            self.shell._feed(self.process, self.input)
+
+        self.capture = StreamCapture(self.process, line_cb=self.shell._line_callbacks(self.out_log, self.line_cb),
+                                     sinks=self.shell._sinks(self.spool),
+                                     deadline=deadline, cancel=cancel, kill_group=True)
+
+    def _complete(self):
+        self.end_time = time.time()
+        if self.capture is None:
+            self._result = self._replayed
+            return
+
+        output, error = self.capture.finish()
+        self._result = self.shell._finish(self.process, output, error)
+
+    def cancel(self, reason='Command cancelled'):
+        """
+        Cancel the command. Queued commands are not started, running commands are killed.
+        """
+        if self.done():
+            return
+
+        if self.capture is None:
+            self._result = self.shell._cancelled_result(self.args, self.spool, reason)
+            if self in self.loop.active:
+                self.loop.active.remove(self)
+        else:
+            self.capture.kill(reason)
+
+    def done(self):
+        return self._result is not None
+
+    def duration(self):
+        """
+        :return: Run time of the command in seconds (excluding the time spent in the queue).
+        """
+        if self.start_time is None:
+            return 0.0
+
+        if self.end_time is None:
+            return 0.0 if self.done() else time.time() - self.start_time
+
+        return self.end_time - self.start_time
+
+    def result(self):
+        """
+        Wait for the command to complete.
+        :return: (ret, out, err) tuple, same as PyShell.cmd()
+        """
+        if not self.done():
+            self.loop.run_until_complete([self])
+
+        return self._result
+
+class CmdLoop(object):
+    """
+    Runs PyShell/GitShell commands concurrently from a single poll loop. At most max_jobs children are alive at any
+    point of time, remaining commands are queued in submission order.
+    """
+    def __init__(self, max_jobs=None, poll_timeout=0.1, logger=None):
+        self.logger = logger or logging.getLogger(__name__)
+        self.max_jobs = max_jobs if max_jobs is not None and max_jobs > 0 else multiprocessing.cpu_count()
+        self.poll_timeout = poll_timeout
+        self.poller = Poller()
+        self.pending = deque()
+        self.active = []
+        self._fd_map = {}
+
+    def submit(self, shell, args, kwargs):
+        future = CmdFuture(self, shell, args, kwargs)
+        self.pending.append(future)
+
+        return future
+
+    def _start_pending(self):
+        while len(self.pending) > 0 and len(self.active) < self.max_jobs:
+            future = self.pending.popleft()
+            if future.done():
+                continue
+            future._start()
+            if future.done():
+                continue
+            self.active.append(future)
+            # Replayed commands have no child, they only wait for the recorded duration.
+            if future.capture is None:
+                continue
+            for fd in future.capture.fds():
+                self.poller.register(fd)
+                self._fd_map[fd] = future
+
+    def _complete(self, future):
+        if future.capture is not None:
+            for fd in future.capture.fds():
+                self.poller.unregister(fd)
+                self._fd_map.pop(fd, None)
+        future._complete()
+        self.active.remove(future)
+
+    def _step(self):
+        timeout = self.poll_timeout
+        for future in self.active:
+            if future.capture is not None:
+                future.capture.check()
+            else:
+                timeout = max(0, min(timeout, future.ready_at - time.time()))
+
+        ready = self.poller.poll(timeout)
+
+        for future in list(self.active):
+            if future.capture is None and future.ready_at <= time.time():
+                self._complete(future)
+
+        if len(ready) == 0:
+            # Children which exited but left their pipes open with a grand child.
+            for future in list(self.active):
+                if future.capture is not None and future.process.poll() is not None:
+                    self._complete(future)
+            return
+
+        for fd in ready:
+            future = self._fd_map.get(fd, None)
+            if future is None:
+                continue
+            if future.capture.handle(fd) is False:
+                self.poller.unregister(fd)
+                self._fd_map.pop(fd, None)
+                if future.capture.done():
+                    self._complete(future)
+
+    def run_until_complete(self, futures=None, fail_fast=False):
+        """
+        Drive the loop until given futures are done.
+        :param futures: List of CmdFuture objects. Wait for all submitted commands if None.
+        :param fail_fast: Set True to cancel the remaining futures as soon as one of them fails.
+        :return: List of (ret, out, err) tuples in the order of futures.
+        """
+        if futures is None:
+            futures = list(self.active) + list(self.pending)
+
+        try:
+            while not all(map(lambda f: f.done(), futures)):
+                self._start_pending()
+                if len(self.active) > 0:
+                    self._step()
+                if fail_fast is True and any(map(lambda f: f.done() and f.result()[0] != 0, futures)):
+                    for future in futures:
+                        future.cancel('Command cancelled, sibling command failed')
+        except BaseException:
+            for future in self.active:
+                if future.capture is not None:
+                    future.capture._signal(signal.SIGKILL)
+            raise
+
+        return [future.result() for future in futures]
+
+    def gather(self, *futures, **kwargs):
+        return self.run_until_complete(list(futures), fail_fast=kwargs.get('fail_fast', False))
+
+_default_loop = None
+
+def get_cmd_loop():
+    """
+    :return: Process wide default CmdLoop.
+    """
+    global _default_loop
+    if _default_loop is None:
+        _default_loop = CmdLoop()
+
+    return _default_loop
+
 class PyShell(object):
-    def __init__(self, wd=os.getcwd(), stream_stdout=False, logger=None):
+    def __init__(self, wd=os.getcwd(), stream_stdout=False, logger=None, timeout=None, cancel=None):
         self.logger = logger or logging.getLogger(__name__)
         self.wd = wd
         self.stream_stdout = stream_stdout
+        # Default per command timeout and cancellation token of this shell.
+        self.timeout = timeout
+        self.cancel_token = cancel
         self.curr_cmd = None
         self.cmd_out = ''
         self.cmd_err = ''
         self.cmd_ret = 0
         self.dry_run = False
+        # Execution metrics of every command are recorded in the shared tracer.
+        self.tracer = get_tracer()
+        self._traces = {}
 
     def dryrun(self, status=False):
         self.dry_run = status
 
-    def _cmd(self, args=[], wd=None, out_log=False, dry_run=False, shell=False):
-        output = list()
-        error = list()
-        wd = wd if wd is not None else self.wd
+    def _line_callbacks(self, out_log=False, line_cb=None):
+        def printer(identifier, line):
+            print identifier + ':', line
+            if out_log is True:
+                self.logger.info(identifier + ': ' + line)
+
+        callbacks = []
+        if self.stream_stdout is True:
+            callbacks.append(printer)
+        if line_cb is not None:
+            callbacks.append(line_cb)
+
+        return callbacks
+
+    def _limits(self, timeout=None, cancel=None):
+        """
+        Resolve the execution limits of a command.
+        :return: Tuple of deadline (or None), CancelToken and whether the command needs its own process group.
+        """
+        timeout = timeout if timeout is not None else self.timeout
+        timeout = timeout if timeout is not None else _default_cmd_timeout
+        cancel = cancel or self.cancel_token or _global_cancel
+
+        deadline = time.time() + timeout if timeout is not None else None
+        limited = deadline is not None or cancel.deadline is not None or cancel is not _global_cancel
+
+        return deadline, cancel, limited
+
+    def _cancelled_result(self, args, spool, reason):
+        self.logger.error("Skipped " + ' '.join(list(args)) + ": " + reason)
+        ret, out, err = self._dry_result(spool)
+        if spool is True:
+            err.append(reason + '\n')
+        else:
+            err = reason + '\n'
 
+        return -1, out, err
+
+    def _feed(self, process, data):
+        """
+        Write data to stdin of the child from a helper thread, so a child which writes a lot of output before it has
+        read all of its input does not block on a full pipe.
+        """
+        def writer():
+            try:
+                process.stdin.write(data)
+            except IOError as e:
+                if e.errno != errno.EPIPE:
+                    raise
+            finally:
+                try:
+                    process.stdin.close()
+                except IOError:
+                    pass
+
+        thread = threading.Thread(target=writer)
+        thread.daemon = True
+        thread.start()
+
+    def _start(self, args, wd, dry_run=False, shell=False, group=False, input=None):
+        """
+        Spawn the given command.
+        :param group: Set True to run the command in its own process group, so it can be killed along with its
+                      children.
+        :param input: Set to the string written to stdin of the command, to connect stdin to a pipe. Caller feeds it.
+                      stdin is inherited if None.
+        :return: Popen object, or None if the command is not executed (dry run).
+        """
         #self.logger.info(args)
-        #self.logger.info('wd=%s, out_log=%s, dry_run=%s, shell=%s' % (wd, out_log, dry_run, shell))
+        #self.logger.info('wd=%s, dry_run=%s, shell=%s' % (wd, dry_run, shell))
         self.logger.info("Executing " + ' '.join(list(args)))
 
-        if len(args) < 0:
-            return -1, '', 'Argument invalid error'
-
         if dry_run or self.dry_run:
-            return 0, '', ''
+            return None
 
         self.curr_cmd = args
-        self.wd = wd
 
-        io_q = Queue()
-        var_q = Queue()
+        trace = self.tracer.start(args, wd)
+        process = Popen(list(args), stdin=PIPE if input is not None else None, stdout=PIPE, stderr=PIPE, cwd=wd,
+                        shell=shell, preexec_fn=os.setpgrp if group is True else None)
+        self._traces[process.pid] = (trace, args, wd, time.time())
 
-        def stream_watcher(identifier, stream):
-            for line in stream:
-                io_q.put((identifier, line))
-                var_q.put((identifier, line))
+        return process
 
-            if not stream.closed:
-                stream.close()
+    def _replay(self, args, wd, dry_run=False, spool=False):
+        """
+        Serve the command from the replay transcript, if replay mode is enabled.
+        :return: Tuple of (ret, out, err) and the recorded duration, or None if the command has to be executed.
+        """
+        transcript = get_transcript()
+        if transcript is None or not transcript.replaying() or dry_run or self.dry_run:
+            return None
 
-        process = Popen(list(args), stdout=PIPE, stderr=PIPE, cwd=wd, shell=shell)
+        self.logger.info("Replaying " + ' '.join(list(args)))
 
-        def printer():
-            while True:
-                try:
-                    # Block for 1 second.
-                    item = io_q.get(True, 1)
-                except Empty:
-                    # No output in either streams for a second. Are we done?
-                    if process.poll() is not None:
-                        break
-                else:
-                    identifier, line = item
-                    print identifier + ':', line
-                    if out_log is True:
-                        self.logger.info(identifier + ': ' + line)
-
-        def parse_output():
-            while True:
-                try:
-                    # Block for 1 second.
-                    item = var_q.get(False)
-                except Empty:
-                    # No output in either streams for a second. Are we done?
-                    if process.poll() is not None:
-                        break
-                else:
-                    identifier, line = item
+        entry = transcript.replay(args, wd)
+        if entry is None:
+            self.logger.error(' '.join(list(args)) + ": command not found in transcript")
+            entry = -1, '', 'Command not found in transcript\n', 0
 
-                    if identifier == "STDERR":
-                        error.append(line)
-                    elif identifier == "STDOUT":
-                        output.append(line)
+        ret, out, err, duration = entry
+        if spool is True:
+            out_spool, err_spool = OutputSpool(), OutputSpool()
+            out_spool.append(out)
+            err_spool.append(err)
+            out, err = out_spool, err_spool
 
-        if self.stream_stdout is True:
-            Thread(target=stream_watcher, name='stdout-watcher', args=('STDOUT', process.stdout)).start()
-            Thread(target=stream_watcher, name='stderr-watcher', args=('STDERR', process.stderr)).start()
-            Thread(target=printer, name='printer').start()
-            parse_output()
+        self.curr_cmd = args
+        self.cmd_ret, self.cmd_out, self.cmd_err = ret, out, err
+
+        return (ret, out, err), duration
+
+    def _sinks(self, spool=False):
+        if spool is True:
+            return OutputSpool(), OutputSpool()
+
+        return list(), list()
+
+    def _dry_result(self, spool=False):
+        if spool is True:
+            return 0, OutputSpool(), OutputSpool()
+
+        return 0, '', ''
+
+    def _finish(self, process, output, error):
+        self.cmd_out = ''.join(output) if isinstance(output, list) else output
+        self.cmd_err = ''.join(error) if isinstance(error, list) else error
+        self.cmd_ret = process.returncode
+
+        trace, args, wd, start = self._traces.pop(process.pid, (None, None, None, None))
+        self.tracer.end(trace, self.cmd_ret, len(self.cmd_out), len(self.cmd_err))
+
+        transcript = get_transcript()
+        if transcript is not None and args is not None:
+            transcript.record(args, wd, self.cmd_ret, self.cmd_out, self.cmd_err, time.time() - start)
+
+        return self.cmd_ret, self.cmd_out, self.cmd_err
+
+    def _cmd(self, args=[], wd=None, out_log=False, dry_run=False, shell=False, line_cb=None, spool=False,
+             timeout=None, cancel=None, input=None):
+        wd = wd if wd is not None else self.wd
+
+        if len(args) < 0:
+            return -1, '', 'Argument invalid error'
+
+        deadline, cancel, limited = self._limits(timeout, cancel)
+        if cancel.cancelled():
+            return self._cancelled_result(args, spool, cancel.reason)
+
+        replay = self._replay(args, wd, dry_run, spool)
+        if replay is not None:
+            time.sleep(replay[1])
+            return replay[0]
+
+        process = self._start(args, wd, dry_run, shell, group=limited, input=input)
+        if process is None:
+            return self._dry_result(spool)
+
+        callbacks = self._line_callbacks(out_log, line_cb)
+
+        if len(callbacks) > 0 or spool is True or limited is True:
+            if input is not None:
+                self._feed(process, input)
+            capture = StreamCapture(process, line_cb=callbacks, sinks=self._sinks(spool),
+                                    deadline=deadline, cancel=cancel, kill_group=limited)
+            output, error = capture.run()
+            if capture.killed is not None:
+                self.logger.error(' '.join(list(args)) + ": " + capture.killed)
         else:
-            _output, _error = process.communicate()
+            _output, _error = process.communicate(input)
             output = [_output]
             error = [_error]
 
@@ -100,32 +816,267 @@ class PyShell(object):
             if len(_error) > 0 and out_log is True:
                 self.logger.error("STDERR: " + _error)
 
-        self.cmd_out = ''.join(output)
-        self.cmd_err = ''.join(error)
-        self.cmd_ret = process.returncode
-
-        return self.cmd_ret, self.cmd_out, self.cmd_err
+        return self._finish(process, output, error)
 
     def cmd(self, *args, **kwargs):
         return self._cmd(args=list(args), wd=kwargs.get('wd', self.wd),
                          out_log=kwargs.get('out_log', False),
                          dry_run=kwargs.get('dry_run', False),
-                         shell=kwargs.get('shell', False))
+                         shell=kwargs.get('shell', False),
+                         line_cb=kwargs.get('line_cb', None),
+                         spool=kwargs.get('spool', False),
+                         timeout=kwargs.get('timeout', None),
+                         cancel=kwargs.get('cancel', None),
+                         input=kwargs.get('input', None))
+
+    def cmd_async(self, *args, **kwargs):
+        """
+        Non blocking version of cmd(). Takes the same arguments as cmd(), and an optional "loop" (CmdLoop) which
+        executes the command.
+        :return: CmdFuture object. Use future.result() or loop.gather() to get the (ret, out, err) tuple.
+        """
+        loop = kwargs.pop('loop', None) or get_cmd_loop()
+
+        return loop.submit(self, list(args), kwargs)
+
+# git sub commands which never modify refs or the work tree.
+GIT_READ_ONLY_COMMANDS = ['log', 'show', 'diff', 'diff-tree', 'diff-index', 'status', 'rev-parse', 'rev-list',
+                          'cat-file', 'ls-files', 'ls-tree', 'ls-remote', 'merge-base', 'describe', 'shortlog',
+                          'for-each-ref', 'show-ref', 'name-rev', 'cherry', 'patch-id', 'format-patch', 'grep',
+                          'blame', 'count-objects', 'merge-tree', 'commit-tree']
+
+# git sub commands which only list things when called without arguments.
+GIT_LIST_COMMANDS = ['branch', 'tag', 'remote']
+
+def git_dirs(wd):
+    """
+    Find the git directories of given work dir. Handles linked work trees, where .git is a file pointing to the
+    per work tree git dir, and the shared refs live in the common dir.
+    :param wd: Work directory.
+    :return: Tuple of git dir and common git dir.
+    """
+    git_dir = os.path.join(wd, '.git')
+    if os.path.isfile(git_dir):
+        with open(git_dir) as fobj:
+            content = fobj.read().strip()
+        if content.startswith('gitdir:'):
+            git_dir = os.path.normpath(os.path.join(wd, content[len('gitdir:'):].strip()))
+
+    common_dir = git_dir
+    if os.path.isfile(os.path.join(git_dir, 'commondir')):
+        with open(os.path.join(git_dir, 'commondir')) as fobj:
+            common_dir = os.path.normpath(os.path.join(git_dir, fobj.read().strip()))
+
+    return git_dir, common_dir
+
+def git_ref_state(wd):
+    """
+    Snapshot of the ref state of given repo. git updates refs by renaming a lock file over the ref, so any ref update
+    changes the mtime of HEAD, packed-refs or the directory which holds the loose ref.
+    :param wd: Work directory.
+    :return: Tuple which changes whenever any ref is updated.
+    """
+    git_dir, common_dir = git_dirs(wd)
+    state = []
+
+    for path in [os.path.join(git_dir, 'HEAD'), os.path.join(common_dir, 'packed-refs')]:
+        try:
+            st = os.stat(path)
+            state.append((st.st_ino, st.st_mtime))
+        except OSError:
+            state.append(None)
+
+    for root, dirs, files in os.walk(os.path.join(common_dir, 'refs')):
+        try:
+            state.append((root, os.stat(root).st_mtime))
+        except OSError:
+            pass
+
+    return tuple(state)
+
+class GitQueryCache(object):
+    """
+    Memoizes results of read-only git queries. Every entry is stored along with the ref state of the repo and a
+    generation number, which GitShell bumps for its own mutating commands, so entries are dropped automatically as
+    soon as any ref changes.
+    """
+    def __init__(self, logger=None):
+        self.logger = logger or logging.getLogger(__name__)
+        self.entries = {}
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def invalidate(self):
+        self.generation += 1
+        self.entries = {}
+
+    def get(self, wd, key, func):
+        """
+        Get cached value of given query, call func to compute it if the cached value is missing or stale.
+        :param wd: Work directory of the repo.
+        :param key: Hashable query key.
+        :param func: Function without arguments which executes the query.
+        :return: Query result.
+        """
+        # Refs do not change on disk while replaying a transcript.
+        transcript = get_transcript()
+        if transcript is not None and transcript.replaying():
+            return func()
+
+        state = (self.generation, git_ref_state(wd))
+        entry = self.entries.get((wd, key), None)
+
+        if entry is not None and entry[0] == state:
+            self.hits += 1
+            return entry[1]
+
+        self.misses += 1
+        value = func()
+        self.entries[(wd, key)] = (state, value)
+
+        return value
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'entries': len(self.entries)}
+
+class GitCatFile(object):
+    """
+    Long lived "git cat-file --batch-check" session. Answers object queries (ref validation, SHA resolution, object
+    type) over a pipe, without spawning a new git process for every query. Queries from several threads are
+    serialised, so that every caller reads the reply to its own request.
+    """
+    BATCH_FORMAT = '%(objectname) %(objecttype) %(objectsize)'
+
+    def __init__(self, wd, logger=None):
+        self.logger = logger or logging.getLogger(__name__)
+        self.wd = wd
+        self.process = None
+        self._lock = threading.RLock()
+
+    def _start(self):
+        self.logger.debug("Starting git cat-file session in %s", self.wd)
+        self.process = Popen([GIT_COMMAND_PATH, 'cat-file', '--batch-check=' + self.BATCH_FORMAT],
+                             stdin=PIPE, stdout=PIPE, stderr=PIPE, cwd=self.wd)
+
+    def _query(self, rev):
+        if self.process is None or self.process.poll() is not None:
+            self._start()
+
+        self.process.stdin.write(rev + '\n')
+        self.process.stdin.flush()
+
+        return self.process.stdout.readline()
+
+    def query(self, rev):
+        """
+        Look up given revision.
+        :param rev: Any revision expression understood by git (SHA, ref name, tag, HEAD~1, <rev>^{commit}, ...).
+        :return: (sha, type, size) tuple, or None if the revision is not valid.
+        """
+        rev = str(rev)
+        if len(rev) == 0 or rev != rev.strip() or '\n' in rev:
+            return None
+
+        with self._lock:
+            try:
+                line = self._query(rev)
+            except (IOError, OSError):
+                line = ''
+
+            # Session died in between, retry once with a new one.
+            if len(line) == 0:
+                self.close()
+                line = self._query(rev)
+
+        # Invalid revisions are reported as "<rev> missing" or "<rev> ambiguous".
+        fields = line.split()
+        if len(fields) != 3 or fields[-1] in ('missing', 'ambiguous'):
+            return None
+
+        return fields[0], fields[1], int(fields[2])
+
+    def close(self):
+        with self._lock:
+            if self.process is None:
+                return
+
+            try:
+                self.process.stdin.close()
+                self.process.wait()
+            except (IOError, OSError):
+                pass
+
+            self.process = None
 
 class GitShell(PyShell):
     def __init__(self, wd=os.getcwd(), init=False, remote_list=[], fetch_all=False, stream_stdout=False, logger=None):
         super(GitShell, self).__init__(wd=wd, stream_stdout=stream_stdout, logger = logger)
+        # cat-file sessions, one per work dir.
+        self._cat_files = {}
+        self._cat_files_lock = threading.Lock()
+        self.query_cache = GitQueryCache(logger=self.logger)
         #self.logger.info('git init=%s, remote_list=%s, fetch_all=%s' % (init, remote_list, fetch_all))
         self.init()
         for remote in remote_list:
             if len(remote) > 0:
                 self.add_remote(remote[0], remote[1], override=True)
         if fetch_all:
-            self.cmd("remote update")
+            self.cmd("remote", "update")
+
+    def _git_args(self, args, shell=False):
+        """
+        Build the command for given git arguments. Plain git commands are executed directly (argv, no intermediate
+        shell). If shell is True, arguments are joined into a single command line and executed with /bin/sh, which
+        is needed for pipelines, redirections and globs.
+        """
+        if shell is True:
+            return [GIT_COMMAND_PATH + ' ' + ' '.join(list(args))]
+
+        return [GIT_COMMAND_PATH] + list(args)
+
+    def _is_mutating(self, args, shell=False):
+        """
+        Check whether given git command can modify refs. Unknown commands and shell command lines are treated as
+        mutating.
+        """
+        if shell is True or len(args) == 0:
+            return True
+
+        if args[0] in GIT_READ_ONLY_COMMANDS:
+            return False
+
+        if args[0] in GIT_LIST_COMMANDS and len(args) == 1:
+            return False
+
+        if args[0] == 'config' and '--get' in args:
+            return False
+
+        return True
 
     def cmd(self, *args, **kwargs):
-        kwargs.pop('shell', None)
-        return super(GitShell, self).cmd(GIT_COMMAND_PATH + ' ' + ' '.join(list(args)), shell=True, **kwargs)
+        shell = kwargs.pop('shell', False)
+        if self._is_mutating(args, shell):
+            self.query_cache.invalidate()
+        return super(GitShell, self).cmd(*self._git_args(args, shell), shell=shell, **kwargs)
+
+    def cmd_async(self, *args, **kwargs):
+        shell = kwargs.pop('shell', False)
+        if self._is_mutating(args, shell):
+            self.query_cache.invalidate()
+        return super(GitShell, self).cmd_async(*self._git_args(args, shell), shell=shell, **kwargs)
+
+    def cached_cmd(self, *args, **kwargs):
+        """
+        Same as cmd(), but the result is memoized until any ref of the repo changes. Use it only for read-only
+        queries.
+        """
+        if self.dry_run:
+            return self.cmd(*args, **kwargs)
+
+        wd = os.path.abspath(kwargs.get('wd', self.wd))
+
+        return self.query_cache.get(wd, ('cmd',) + tuple(args), lambda: self.cmd(*args, **kwargs))
 
     def valid(self,  **kwargs):
         return True if os.path.exists(os.path.join(kwargs.get('wd', self.wd), '.git')) else False
@@ -151,18 +1102,220 @@ class GitShell(PyShell):
         else:
             return self.cmd('push', remote, lbranch + ':' + rbranch, **kwargs)
 
+    def add_worktree(self, path, branch, start, **kwargs):
+        """
+        Create a worktree at path, with branch reset to start and checked out in it. Existing worktree at the same
+        path is removed first.
+        :param path: Worktree directory.
+        :param branch: Branch name, or None to checkout start as detached HEAD.
+        :param start: Start point of the branch.
+        :return: (ret, out, err) of git worktree add.
+        """
+        self.remove_worktree(path, **kwargs)
+
+        if branch is None:
+            return self.cmd('worktree', 'add', '--force', '--detach', path, start, **kwargs)
+
+        return self.cmd('worktree', 'add', '--force', '-B', branch, path, start, **kwargs)
+
+    def remove_worktree(self, path, **kwargs):
+        """
+        Remove the worktree at path. Branch checked out in it is not deleted.
+        :param path: Worktree directory.
+        :return: (ret, out, err) of git worktree prune.
+        """
+        if os.path.exists(path):
+            self.cmd('worktree', 'remove', '--force', path, **kwargs)
+
+        return self.cmd('worktree', 'prune', **kwargs)
+
+    def add_alternate(self, objects_dir, **kwargs):
+        """
+        Borrow objects from another object store (same as git clone --reference). Objects present in it are not
+        fetched or stored again.
+        :param objects_dir: objects directory of the other repo.
+        :return: True if the alternate was added, False if it was already present.
+        """
+        common_dir = git_dirs(kwargs.get('wd', self.wd))[1]
+        info_dir = os.path.join(common_dir, 'objects', 'info')
+        alternates = os.path.join(info_dir, 'alternates')
+        objects_dir = os.path.abspath(objects_dir)
+
+        if os.path.exists(alternates):
+            with open(alternates) as fobj:
+                if objects_dir in fobj.read().splitlines():
+                    return False
+        elif not os.path.exists(info_dir):
+            os.makedirs(info_dir)
+
+        with open(alternates, 'a') as fobj:
+            fobj.write(objects_dir + '\n')
+
+        # Running cat-file sessions only read the alternates at startup.
+        for cat_file in self._cat_files.values():
+            cat_file.close()
+        self.query_cache.invalidate()
+
+        return True
+
+    def merge_tree(self, ours, theirs, **kwargs):
+        """
+        Merge two commits in memory (git merge-tree --write-tree), without touching the index or the work tree.
+        :param ours: First commit.
+        :param theirs: Second commit.
+        :return: (status, tree, files, messages) tuple. status is "clean", "conflict" or "error", tree is the SHA ID
+        of the merged tree (with conflict markers if any), files the list of conflicting paths and messages the
+        informational messages of the merge (or the error).
+        """
+        ret, out, err = self.cmd('merge-tree', '--write-tree', '--name-only', ours, theirs, **kwargs)
+
+        sections = out.split('\n\n', 1)
+        lines = sections[0].splitlines()
+        messages = sections[1].strip() if len(sections) > 1 else ''
+
+        # Invalid refs also exit with 1, but without a tree.
+        if ret not in (0, 1) or len(lines) == 0:
+            return 'error', '', [], err.strip()
+
+        return 'clean' if ret == 0 else 'conflict', lines[0].strip(), lines[1:], messages
+
+    def unmerged_paths(self, **kwargs):
+        """
+        :return: List of paths with unmerged (conflicting) entries in the index.
+        """
+        paths = []
+        seen = set()
+        for entry in self.cmd('ls-files', '-u', '-z', **kwargs)[1].split('\0'):
+            if '\t' not in entry:
+                continue
+            path = entry.split('\t', 1)[1]
+            if path not in seen:
+                seen.add(path)
+                paths.append(path)
+
+        return paths
+
+    def conflict_state(self, **kwargs):
+        """
+        Get the conflict state of the index. Unmerged paths whose conflicts were already resolved in the work tree by
+        rerere (without rerere.autoupdate) are reported separately, they only need to be staged.
+        :return: (unresolved, resolved) tuple of path lists.
+        """
+        unmerged = self.unmerged_paths(**kwargs)
+        if len(unmerged) == 0:
+            return [], []
+
+        if self.cmd('config', '--bool', '--get', 'rerere.enabled', **kwargs)[1].strip() != 'true':
+            return unmerged, []
+
+        remaining = set(self.cmd('rerere', 'remaining', **kwargs)[1].splitlines())
+
+        return [path for path in unmerged if path in remaining], [path for path in unmerged if path not in remaining]
+
+    def rebase_in_progress(self, **kwargs):
+        wd = kwargs.get('wd', self.wd)
+        for name in ('rebase-merge', 'rebase-apply'):
+            path = self.cmd('rev-parse', '--git-path', name, **kwargs)[1].strip()
+            if len(path) > 0 and os.path.exists(os.path.join(wd, path)):
+                return True
+
+        return False
+
+    def local_branches(self, **kwargs):
+        """
+        :return: List of local branch names (cached "git branch" output).
+        """
+        out = self.cached_cmd('branch', **kwargs)[1]
+
+        # Branches checked out in other worktrees are marked with '+'.
+        return map(lambda it: it.strip().replace('* ', '').replace('+ ', ''), out.splitlines())
+
     def current_branch(self, **kwargs):
-        cmd_str = "branch | awk -v FS=' ' '/\*/{print $NF}' | sed 's|[()]||g'"
-        return self.cmd(cmd_str, shell=True, **kwargs)[1].strip()
+        for line in self.cached_cmd('branch', **kwargs)[1].splitlines():
+            if line.startswith('*'):
+                return line.split()[-1].replace('(', '').replace(')', '')
+
+        return ''
+
+    def object_info(self, rev, **kwargs):
+        """
+        Get object details of given revision using the persistent cat-file session.
+        :param rev: Revision expression.
+        :param kwargs: wd - Work directory of the repo.
+        :return: (sha, type, size) tuple, or None if the revision is not valid.
+        """
+        wd = os.path.abspath(kwargs.get('wd', self.wd))
+
+        if self.dry_run:
+            self.logger.info("Executing cat-file query " + str(rev))
+            return '', '', 0
+
+        return self.query_cache.get(wd, ('object', str(rev)), lambda: self._query_object(rev, wd))
+
+    def _query_object(self, rev, wd):
+        # cat-file queries are recorded/replayed as one shot "git cat-file --batch-check <rev>" commands.
+        args = [GIT_COMMAND_PATH, 'cat-file', '--batch-check', str(rev)]
+        transcript = get_transcript()
+
+        replay = self._replay(args, wd)
+        if replay is not None:
+            ret, out, err = replay[0]
+            fields = str(out).split()
+            return (fields[0], fields[1], int(fields[2])) if ret == 0 and len(fields) == 3 else None
+
+        with self._cat_files_lock:
+            if wd not in self._cat_files:
+                self._cat_files[wd] = GitCatFile(wd, logger=self.logger)
+
+        info = self._cat_files[wd].query(rev)
+
+        if transcript is not None and transcript.recording():
+            transcript.record(args, wd, 0 if info is not None else 1,
+                              ' '.join(map(str, info)) if info is not None else '', '', 0)
+
+        return info
+
+    def is_valid_ref(self, rev, **kwargs):
+        return self.object_info(rev, **kwargs) is not None
+
+    def rev_parse(self, rev, **kwargs):
+        """
+        :return: Full SHA of given revision or None if its not valid.
+        """
+        info = self.object_info(rev, **kwargs)
+
+        return info[0] if info is not None else None
+
+    def object_type(self, rev, **kwargs):
+        """
+        :return: Object type (commit, tree, blob, tag) of given revision or None if its not valid.
+        """
+        info = self.object_info(rev, **kwargs)
+
+        return info[1] if info is not None else None
+
+    def close(self):
+        """
+        Close the persistent cat-file sessions.
+        """
+        with self._cat_files_lock:
+            for session in self._cat_files.values():
+                session.close()
+            self._cat_files = {}
 
     def get_sha(self, commit='HEAD', shalen=12, index="head", **kwargs):
-        cmd_str = "log %s --oneline --abbrev=%d | %s -1 | cut -d' ' -f1" % (commit, shalen, index)
+        if index == "head":
+            sha = self.rev_parse(str(commit) + '^{commit}', **kwargs)
+            return sha[:shalen] if sha is not None else None
 
-        ret, out, err = self.cmd(cmd_str, shell=True, **kwargs)
+        # Last commit of "git log <commit>" is a root commit, so only walk the root commits.
+        ret, out, err = self.cached_cmd('rev-list', '--max-parents=0', commit, **kwargs)
         if ret != 0:
             return None
 
-        return out.strip()
+        roots = out.strip().splitlines()
+
+        return roots[-1][:shalen] if len(roots) > 0 else ''
 
     def base_sha(self, **kwargs):
         return self.get_sha(index="tail", **kwargs)
@@ -170,6 +1323,39 @@ class GitShell(PyShell):
     def head_sha(self, **kwargs):
         return self.get_sha(**kwargs)
 
+def parse_push_porcelain(out):
+    """
+    Parse the output of git push --porcelain.
+    :param out: stdout of the push.
+    :return: List of (source ref, destination ref, flag, summary) tuples, one per pushed ref. Flag is one of
+    ' ' (fast forward), '+' (forced), '-' (deleted), '*' (new), '=' (up to date) and '!' (rejected or failed).
+    """
+    results = []
+    for line in out.splitlines():
+        fields = line.split('\t')
+        if len(fields) != 3 or len(fields[0]) != 1:
+            continue
+        src, dst = fields[1].split(':', 1) if ':' in fields[1] else ('', fields[1])
+        results.append((src, dst, fields[0], fields[2]))
+
+    return results
+
+def push_refs(pushes, jobs=None, logger=None):
+    """
+    Push several refs per remote with a single git push each, and push the remotes concurrently.
+    :param pushes: List of (GitShell, remote, refspecs) tuples.
+    :param jobs: Max number of concurrent pushes, all of them if None.
+    :param logger: Logger object.
+    :return: List of (ret, refs, err) tuples in the order of pushes, refs as returned by parse_push_porcelain().
+    """
+    if len(pushes) == 0:
+        return []
+
+    loop = CmdLoop(max_jobs=jobs or len(pushes), logger=logger)
+    futures = [git.cmd_async('push', '--porcelain', remote, *refspecs, loop=loop) for git, remote, refspecs in pushes]
+
+    return [(ret, parse_push_porcelain(out), err) for ret, out, err in loop.gather(*futures)]
+
 if __name__ == '__main__':
 
     logger = logging.getLogger(__name__)
@@ -0,0 +1,390 @@
+#!/usr/bin/env python
+#
+# Incremental quilt series export
+#
+# Copyright (C) 2018 Sathya Kuppuswamy
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# @Author  : Sathya Kupppuswamy(sathyaosid@gmail.com)
+# @History :
+#            @v0.0 - Basic class support
+# @TODO    :
+#
+#
+
+import os
+import json
+import hashlib
+import logging
+import tempfile
+import shutil
+
+from pyshell import PyShell, CmdLoop
+
+INDEX_NAME = '.patch-index.json'
+CACHE_NAME = '.patch-cache'
+
+# Max length of the Subject header lines written by git format-patch (rfc2822).
+SUBJECT_WIDTH = 78
+
+# Same white space characters as git's isspace().
+GIT_SPACE = ' \t\n\r'
+
+def wrap_text(text, indent1, indent2, width):
+    """
+    Wrap text the same way git does for e-mail headers (strbuf_add_wrapped_text() of git, ASCII text only).
+    :param text: Text to wrap.
+    :param indent1: Indent of the first line. A negative value is the length of the text already on the first line.
+    :param indent2: Indent of the next lines.
+    :param width: Max line length.
+    :return: Wrapped text.
+    """
+    out = []
+    i = bol = 0
+    w = indent = indent1
+    space = None
+    if indent < 0:
+        w = -indent
+        space = 0
+
+    while True:
+        c = text[i] if i < len(text) else ''
+        if c != '' and c not in GIT_SPACE:
+            w += 1
+            i += 1
+            continue
+
+        new_line = True
+        if w <= width or space is None:
+            start = bol
+            if c == '' and i == start:
+                return ''.join(out)
+            if space is not None:
+                start = space
+            else:
+                out.append(' ' * indent)
+            out.append(text[start:i])
+            if c == '':
+                return ''.join(out)
+            space = i
+            new_line = False
+            if c == '\t':
+                w |= 0x07
+            elif c == '\n':
+                space += 1
+                next_c = text[space] if space < len(text) else ''
+                if next_c == '\n':
+                    out.append('\n')
+                    new_line = True
+                elif not next_c.isalnum():
+                    new_line = True
+                else:
+                    out.append(' ')
+            if new_line is False:
+                w += 1
+                i += 1
+                continue
+
+        out.append('\n')
+        i = bol = space + (1 if space < len(text) and text[space] in GIT_SPACE else 0)
+        space = None
+        w = indent = indent2
+
+def subject_header(title, prefix):
+    """
+    :return: Subject header written by git format-patch for given commit title and subject prefix.
+    """
+    header = 'Subject: [%s] ' % prefix
+
+    return header + wrap_text(title, -len(header), 1, SUBJECT_WIDTH)
+
+class QuiltExporter(object):
+    """
+    Export a commit range as a quilt series, with the same output as git format-patch -C -M base..head. Patches are
+    formatted without numbering and cached in <patch_dir>/.patch-cache, keyed by the trees of the commit and its parent,
+    author, date, message and git version, so only new or changed commits are formatted again. The
+    "From <SHA ID>" line and the "[PATCH n/m]" subject prefix are set when the series is written, the Subject header is
+    wrapped again the same way git does. Commits whose subject git would encode (non ASCII) are formatted by git with
+    their final prefix instead.
+
+    Patch files are only written if their content changed, and the sed script is applied to the written files.
+    The cache and output state is stored in <patch_dir>/.patch-index.json.
+    """
+    def __init__(self, git, patch_dir, jobs=None, sed_file=None, series_name='series', logger=None):
+        """
+        :param git: GitShell object of the repo.
+        :param patch_dir: Output directory.
+        :param jobs: Max number of parallel format-patch commands (used for the patches git has to number itself),
+                     number of CPUs if None.
+        :param sed_file: Sed script applied to the written patch files.
+        :param series_name: Name of the series file.
+        :param logger: Logger object.
+        """
+        self.logger = logger or logging.getLogger(__name__)
+        self.git = git
+        self.patch_dir = os.path.abspath(patch_dir)
+        self.cache_dir = os.path.join(self.patch_dir, CACHE_NAME)
+        self.loop = CmdLoop(max_jobs=jobs, logger=self.logger)
+        self.sed_file = os.path.abspath(sed_file) if sed_file is not None else None
+        self.series_name = series_name
+        self.index_path = os.path.join(self.patch_dir, INDEX_NAME)
+        self.sh = PyShell(wd=self.patch_dir, logger=self.logger)
+
+    def _load_index(self):
+        """
+        :return: Dict with "cache" (key -> patch file name suffix) and "outputs" (patch file name -> render ID).
+        """
+        index = {}
+        if os.path.exists(self.index_path):
+            try:
+                with open(self.index_path) as fobj:
+                    index = json.load(fobj)
+            except ValueError:
+                self.logger.warn("Ignoring invalid patch index %s" % self.index_path)
+
+        if not isinstance(index.get('cache', None), dict) or not isinstance(index.get('outputs', None), dict):
+            return {'cache': {}, 'outputs': {}}
+
+        return index
+
+    def _save_index(self, index):
+        tmp_path = self.index_path + '.tmp'
+        with open(tmp_path, 'w+') as fobj:
+            json.dump(index, fobj, indent=4, sort_keys=True)
+        os.rename(tmp_path, self.index_path)
+
+    def _cache_path(self, key):
+        return os.path.join(self.cache_dir, key + '.patch')
+
+    def _commits(self, base, head):
+        """
+        :return: Ordered list of (SHA ID, title, key) tuples of non merge commits in base..head.
+        """
+        rev_range = base + '..' + head
+
+        ret, out, err = self.git.cmd('log', '--reverse', '--no-merges',
+                                     '--format=%H%x00%T%x00%P%x00%s%x00%an%x00%ae%x00%ad%x00%B%x01', rev_range)
+        if ret != 0:
+            raise Exception("git log %s failed, error: %s" % (rev_range, err))
+
+        commits = []
+        for record in out.split('\x01'):
+            record = record.strip('\n')
+            if record == '':
+                continue
+            sha, tree, parents, title, info = record.split('\x00', 4)
+            commits.append((sha, tree, parents.split()[0] if len(parents) > 0 else '', title, info))
+
+        # The diff of a commit only depends on its tree and the tree of its parent.
+        trees = dict([(sha, tree) for sha, tree, parent, title, info in commits])
+        parents = sorted(set([parent for sha, tree, parent, title, info in commits
+                              if parent != '' and parent not in trees]))
+        if len(parents) > 0:
+            ret, out, err = self.git.cmd('rev-parse', *[parent + '^{tree}' for parent in parents])
+            if ret != 0:
+                raise Exception("git rev-parse of parent trees failed, error: %s" % err)
+            trees.update(zip(parents, out.split()))
+
+        ret, out, err = self.git.cmd('--version')
+        if ret != 0:
+            raise Exception("git --version failed, error: %s" % err)
+        version = out.strip()
+
+        return [(sha, title, hashlib.sha1('\n'.join([trees.get(parent, ''), tree, version, info])).hexdigest())
+                for sha, tree, parent, title, info in commits]
+
+    def _git_wraps(self, title):
+        """
+        :return: True if wrap_text() wraps given title the same way as git, False if git would encode it.
+        """
+        return '=?' not in title and all([' ' <= c <= '~' or c == '\t' for c in title])
+
+    def _format(self, args, shas, out_dir, input=None):
+        """
+        Run git format-patch for given commits.
+        :return: List of patch file paths, in the order of shas.
+        """
+        ret, out, err = self.git.cmd('format-patch', '-C', '-M', '--no-walk=unsorted', '-%d' % len(shas), '-o',
+                                     out_dir, *args, input=input)
+        if ret != 0:
+            raise Exception("git format-patch failed, out: %s error: %s" % (out, err))
+        paths = [line.strip() for line in out.splitlines() if line.strip() != '']
+        if len(paths) != len(shas):
+            raise Exception("git format-patch created %d patches, expected %d" % (len(paths), len(shas)))
+
+        return paths
+
+    def _update_cache(self, commits, index, tmp_dir):
+        """
+        Format the commits missing in the cache, in a single unnumbered format-patch run.
+        :param commits: List of (SHA ID, title, key) tuples.
+        :param index: Patch index, updated with the new cache entries.
+        :param tmp_dir: Scratch directory.
+        :return: None
+        """
+        missing = []
+        keys = set()
+        for sha, title, key in commits:
+            if key in keys or (key in index['cache'] and os.path.exists(self._cache_path(key))):
+                continue
+            if self._git_wraps(title) is True:
+                missing.append((sha, title, key))
+                keys.add(key)
+
+        self.logger.info("Exporting %d patches, %d new or changed" % (len(commits), len(missing)))
+
+        if len(missing) == 0:
+            return
+
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+        # format-patch reverses the walk, so commits are given in reverse order. The count keeps a single commit
+        # from being read as <since>.
+        out_dir = os.path.join(tmp_dir, 'cache')
+        paths = self._format(['-N', '--stdin'], missing, out_dir,
+                             input=''.join([sha + '\n' for sha, title, key in reversed(missing)]))
+
+        for (sha, title, key), path in zip(missing, paths):
+            with open(path) as fobj:
+                content = fobj.read()
+            # Only cache patches which can be numbered later on exactly like format-patch would do.
+            if len(content) > 0 and self._subject_lines(content)[2] != subject_header(title, 'PATCH'):
+                self.logger.warn("Subject of %s is not wrapped as expected, formatting it with git" % sha)
+                continue
+            os.rename(path, self._cache_path(key))
+            index['cache'][key] = os.path.basename(path).split('-', 1)[1]
+
+    def _subject_lines(self, content):
+        """
+        :return: Tuple of header lines, start and end index of the Subject header lines, and the Subject header.
+        """
+        lines = content.partition('\n\n')[0].split('\n')
+        start = [i for i, line in enumerate(lines) if line.startswith('Subject: ')][0]
+        end = start + 1
+        while end < len(lines) and lines[end].startswith(' '):
+            end += 1
+
+        return lines, (start, end), '\n'.join(lines[start:end])
+
+    def _render(self, key, sha, title, prefix, path):
+        """
+        Write the patch of a commit from its cached unnumbered patch.
+        """
+        with open(self._cache_path(key)) as fobj:
+            content = fobj.read()
+
+        # Commits without a diff have empty patch files.
+        if len(content) > 0:
+            lines, (start, end), subject = self._subject_lines(content)
+            body = content[len('\n'.join(lines)):]
+            lines[start:end] = subject_header(title, prefix).split('\n')
+            lines[0] = 'From %s Mon Sep 17 00:00:00 2001' % sha
+            content = '\n'.join(lines) + body
+
+        with open(path, 'w') as fobj:
+            fobj.write(content)
+
+    def export(self, base, head, series_comment=''):
+        """
+        Update the quilt series in patch_dir to match base..head.
+        :param base: Base SHA ID.
+        :param head: Head SHA ID.
+        :param series_comment: Text written at the top of the series file.
+        :return: Ordered list of patch file names.
+        """
+        if not os.path.exists(self.patch_dir):
+            os.makedirs(self.patch_dir)
+
+        index = self._load_index()
+        commits = self._commits(base.strip(), head.strip())
+        total = len(commits)
+
+        sed_digest = ''
+        if self.sed_file is not None:
+            with open(self.sed_file) as fobj:
+                sed_digest = hashlib.sha1(fobj.read()).hexdigest()
+
+        tmp_dir = tempfile.mkdtemp(prefix='.format-', dir=self.patch_dir)
+        try:
+            self._update_cache(commits, index, tmp_dir)
+
+            names = []
+            outputs = {}
+            previous = dict([(render_id, name) for name, render_id in index['outputs'].items()
+                             if os.path.exists(os.path.join(self.patch_dir, name))])
+            written = []
+            uncached = []
+            for position, (sha, title, key) in enumerate(commits):
+                prefix = 'PATCH %0*d/%d' % (len(str(total)), position + 1, total) if total > 1 else 'PATCH'
+                render_id = hashlib.sha1('\n'.join([key, sha, prefix, sed_digest])).hexdigest()
+
+                if key in index['cache']:
+                    name = '%04d-%s' % (position + 1, index['cache'][key])
+                    names.append(name)
+                    outputs[name] = render_id
+                    if previous.get(render_id, None) == name:
+                        continue
+                    path = os.path.join(tmp_dir, name)
+                    self._render(key, sha, title, prefix, path)
+                    written.append((name, path))
+                elif render_id in previous:
+                    names.append(previous[render_id])
+                    outputs[previous[render_id]] = render_id
+                else:
+                    names.append(None)
+                    uncached.append((position, sha, prefix, render_id))
+
+            # Patches git has to number itself, each one has its own subject prefix.
+            futures = []
+            for position, sha, prefix, render_id in uncached:
+                out_dir = os.path.join(tmp_dir, 'git-%d' % position)
+                futures.append(self.git.cmd_async('format-patch', '-C', '-M', '-N', '--subject-prefix=' + prefix,
+                                                  '--start-number=%d' % (position + 1), '--no-walk=unsorted', '-1',
+                                                  '-o', out_dir, sha, loop=self.loop))
+            for (position, sha, prefix, render_id), (ret, out, err) in zip(uncached, self.loop.gather(*futures)):
+                if ret != 0:
+                    raise Exception("git format-patch failed, out: %s error: %s" % (out, err))
+                path = out.strip()
+                names[position] = os.path.basename(path)
+                outputs[names[position]] = render_id
+                written.append((names[position], path))
+
+            if self.sed_file is not None and len(written) > 0:
+                ret, out, err = self.sh.cmd('sed', '-i', '-f', self.sed_file, *[path for name, path in written])
+                if ret != 0:
+                    raise Exception("sed command failed %s" % err)
+
+            for name, path in written:
+                os.rename(path, os.path.join(self.patch_dir, name))
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+        self.logger.info("Wrote %d of %d patch files" % (len(written), total))
+
+        for name in os.listdir(self.patch_dir):
+            if name.endswith('.patch') and name not in names:
+                os.remove(os.path.join(self.patch_dir, name))
+
+        keys = set([key for sha, title, key in commits])
+        for key in index['cache'].keys():
+            if key not in keys:
+                del index['cache'][key]
+        if os.path.exists(self.cache_dir):
+            for name in os.listdir(self.cache_dir):
+                if name[:-len('.patch')] not in index['cache']:
+                    os.remove(os.path.join(self.cache_dir, name))
+
+        series_path = os.path.join(self.patch_dir, self.series_name)
+        with open(series_path + '.tmp', 'w+') as fobj:
+            fobj.write(series_comment)
+            fobj.write(''.join([name + '\n' for name in names]))
+        os.rename(series_path + '.tmp', series_path)
+
+        self._save_index({'cache': index['cache'], 'outputs': outputs})
+
+        return names
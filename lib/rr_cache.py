@@ -0,0 +1,397 @@
+#!/usr/bin/env python
+#
+# Incremental git rerere cache synchronization
+#
+# Copyright (C) 2018 Sathya Kuppuswamy
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# @Author  : Sathya Kupppuswamy(sathyaosid@gmail.com)
+# @History :
+#            @v0.0 - Basic class support
+# @TODO    :
+#
+#
+
+import os
+import json
+import time
+import shutil
+import hashlib
+import logging
+import tempfile
+from pyshell import PyShell
+
+MANIFEST_NAME = 'manifest.json'
+
+# smbclient errors of a missing remote file.
+SMB_MISSING_STATUS = ['NT_STATUS_OBJECT_NAME_NOT_FOUND', 'NT_STATUS_NO_SUCH_FILE', 'NT_STATUS_OBJECT_PATH_NOT_FOUND']
+
+# Default age of unused entries to prune, same as git rerere gc (gc.rerereResolved).
+DEFAULT_MAX_AGE_DAYS = 60
+
+class RRCacheBackend(object):
+    """
+    Remote storage of rerere entries. Each entry is a directory named by its conflict ID, and the manifest is stored
+    next to them.
+    """
+    def __init__(self, logger=None):
+        self.logger = logger or logging.getLogger(__name__)
+        self.sh = PyShell(logger=self.logger)
+
+    def _check(self, ret, out, err, msg):
+        if ret != 0:
+            self.logger.error(out)
+            self.logger.error(err)
+            raise Exception("%s. Code: %s" % (msg, ret))
+
+    def read_manifest(self):
+        """
+        :return: Remote manifest dict, empty dict if there is no manifest yet. Raises an exception if the manifest
+        could not be transferred.
+        """
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp_dir, MANIFEST_NAME)
+            if self.get_file(MANIFEST_NAME, path) is False:
+                return {}
+            with open(path) as fobj:
+                return json.load(fobj)
+        except ValueError:
+            self.logger.warn("Ignoring invalid remote rr-cache manifest")
+            return {}
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def write_manifest(self, manifest):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp_dir, MANIFEST_NAME)
+            with open(path, 'w+') as fobj:
+                json.dump(manifest, fobj, indent=4, sort_keys=True)
+            self.put_file(path, MANIFEST_NAME)
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def get_file(self, name, path):
+        """
+        Copy remote file name to local path.
+        :return: True if the file was copied, False if the remote file does not exist. Raises an exception if the
+        transfer failed.
+        """
+        raise NotImplementedError
+
+    def put_file(self, path, name):
+        raise NotImplementedError
+
+    def download(self, ids, local_dir):
+        """
+        Copy given entries from remote to local_dir.
+        """
+        raise NotImplementedError
+
+    def upload(self, ids, local_dir):
+        """
+        Copy given entries from local_dir to remote.
+        """
+        raise NotImplementedError
+
+    def delete(self, ids):
+        raise NotImplementedError
+
+class LocalBackend(RRCacheBackend):
+    """
+    Remote cache in a local (or network mounted) directory.
+    """
+    def __init__(self, path, logger=None):
+        super(LocalBackend, self).__init__(logger=logger)
+        self.path = path
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+
+    def get_file(self, name, path):
+        if not os.path.exists(os.path.join(self.path, name)):
+            return False
+        shutil.copy(os.path.join(self.path, name), path)
+        return True
+
+    def put_file(self, path, name):
+        shutil.copy(path, os.path.join(self.path, name + '.tmp'))
+        os.rename(os.path.join(self.path, name + '.tmp'), os.path.join(self.path, name))
+
+    def _copy(self, src, dst):
+        shutil.rmtree(dst, ignore_errors=True)
+        shutil.copytree(src, dst)
+
+    def download(self, ids, local_dir):
+        for rr_id in ids:
+            self._copy(os.path.join(self.path, rr_id), os.path.join(local_dir, rr_id))
+
+    def upload(self, ids, local_dir):
+        for rr_id in ids:
+            self._copy(os.path.join(local_dir, rr_id), os.path.join(self.path, rr_id))
+
+    def delete(self, ids):
+        for rr_id in ids:
+            shutil.rmtree(os.path.join(self.path, rr_id), ignore_errors=True)
+
+class SmbBackend(RRCacheBackend):
+    """
+    Remote cache in a directory of a SMB share, accessed with smbclient.
+    """
+    def __init__(self, server, share, remote_dir='', username='', password='', options=[], logger=None):
+        super(SmbBackend, self).__init__(logger=logger)
+        self.remote_dir = remote_dir
+        self.args = ["//" + server + '/' + share]
+        if len(password) > 0:
+            self.args.append(password)
+        else:
+            self.args.append("-N")
+        if len(username) > 0:
+            self.args.append("-U")
+            self.args.append(username)
+        self.args += options
+
+    def _smb(self, commands):
+        commands = ['prompt OFF', 'recurse ON'] + (['cd "%s"' % self.remote_dir] if self.remote_dir else []) + commands
+        return self.sh.cmd(*(['smbclient'] + self.args + ['-c', '; '.join(commands)]))
+
+    def get_file(self, name, path):
+        ret, out, err = self._smb(['get "%s" "%s"' % (name, path)])
+        if any([status in out + err for status in SMB_MISSING_STATUS]):
+            return False
+        # Older smbclient versions exit with 0 even if a command failed.
+        if ret == 0 and 'NT_STATUS_' in out + err:
+            ret = 1
+        self._check(ret, out, err, "Downloading %s failed" % name)
+        return True
+
+    def put_file(self, path, name):
+        ret, out, err = self._smb(['put "%s" "%s"' % (path, name)])
+        self._check(ret, out, err, "Uploading %s failed" % name)
+
+    def download(self, ids, local_dir):
+        commands = []
+        for rr_id in ids:
+            if not os.path.exists(os.path.join(local_dir, rr_id)):
+                os.makedirs(os.path.join(local_dir, rr_id))
+            commands += ['cd "%s"' % rr_id, 'lcd "%s"' % os.path.join(local_dir, rr_id), 'mget *', 'cd ..']
+        ret, out, err = self._smb(commands)
+        self._check(ret, out, err, "Downloading rr-cache entries failed")
+
+    def upload(self, ids, local_dir):
+        commands = []
+        for rr_id in ids:
+            commands += ['mkdir "%s"' % rr_id, 'cd "%s"' % rr_id, 'lcd "%s"' % os.path.join(local_dir, rr_id),
+                         'mput *', 'cd ..']
+        ret, out, err = self._smb(commands)
+        self._check(ret, out, err, "Uploading rr-cache entries failed")
+
+    def delete(self, ids):
+        ret, out, err = self._smb(['deltree "%s"' % rr_id for rr_id in ids])
+        self._check(ret, out, err, "Deleting rr-cache entries failed")
+
+class RsyncBackend(RRCacheBackend):
+    """
+    Remote cache accessed with rsync, url is either rsync://server/module/dir or [user@]server:dir (ssh).
+    """
+    def __init__(self, url, options=[], logger=None):
+        super(RsyncBackend, self).__init__(logger=logger)
+        self.url = url.rstrip('/')
+        self.options = options
+
+    def _rsync(self, *args):
+        return self.sh.cmd(*(['rsync'] + self.options + list(args)))
+
+    def _files_from(self, ids):
+        fobj = tempfile.NamedTemporaryFile(suffix='.list')
+        fobj.write(''.join([rr_id + '/\n' for rr_id in ids]))
+        fobj.flush()
+        return fobj
+
+    def get_file(self, name, path):
+        ret, out, err = self._rsync('-a', self.url + '/' + name, path)
+        # rsync exits with 23 (partial transfer) if the source file does not exist.
+        if ret == 23 and 'No such file or directory' in err:
+            return False
+        self._check(ret, out, err, "Downloading %s failed" % name)
+        return True
+
+    def put_file(self, path, name):
+        ret, out, err = self._rsync('-a', path, self.url + '/' + name)
+        self._check(ret, out, err, "Uploading %s failed" % name)
+
+    def download(self, ids, local_dir):
+        with self._files_from(ids) as fobj:
+            ret, out, err = self._rsync('-a', '-r', '--files-from=' + fobj.name, self.url + '/', local_dir + '/')
+        self._check(ret, out, err, "Downloading rr-cache entries failed")
+
+    def upload(self, ids, local_dir):
+        with self._files_from(ids) as fobj:
+            ret, out, err = self._rsync('-a', '-r', '--files-from=' + fobj.name, local_dir + '/', self.url + '/')
+        self._check(ret, out, err, "Uploading rr-cache entries failed")
+
+    def delete(self, ids):
+        # Sync an empty directory with --delete, and exclude everything except the entries to delete.
+        empty_dir = tempfile.mkdtemp()
+        try:
+            filters = ['--include=/%s/***' % rr_id for rr_id in ids] + ['--exclude=*']
+            ret, out, err = self._rsync(*(['-r', '--delete'] + filters + [empty_dir + '/', self.url + '/']))
+        finally:
+            shutil.rmtree(empty_dir, ignore_errors=True)
+        self._check(ret, out, err, "Deleting rr-cache entries failed")
+
+def get_backend(protocol, params, logger=None):
+    """
+    Create the backend of given protocol.
+    :param protocol: "smb", "rsync" or "local".
+    :param params: Dict with remote-cache-params.
+    :return: RRCacheBackend object.
+    """
+    remote_dir = params.get('remote-dir', '')
+    options = params.get('backend-options', [])
+
+    if protocol == 'smb':
+        return SmbBackend(params['server-name'], params['share-point'], remote_dir, params.get('username', ''),
+                          params.get('password', ''), options, logger=logger)
+    elif protocol == 'rsync':
+        user = params['username'] + '@' if len(params.get('username', '')) > 0 else ''
+        if len(params.get('share-point', '')) > 0:
+            url = 'rsync://%s%s/%s/%s' % (user, params['server-name'], params['share-point'], remote_dir)
+        else:
+            url = '%s%s:%s' % (user, params['server-name'], remote_dir)
+        return RsyncBackend(url, options, logger=logger)
+    elif protocol == 'local':
+        if len(remote_dir) == 0:
+            raise Exception("remote-dir must be set for the local rr-cache protocol")
+        return LocalBackend(remote_dir, logger=logger)
+
+    raise Exception("Unsupported rr-cache protocol %s" % protocol)
+
+class RRCacheSync(object):
+    """
+    Manifest based synchronization of a local rerere cache with a remote one. The manifest maps every conflict ID to
+    the hash of its pre/post images and the last time it was used, so only new or changed entries are transferred,
+    and entries unused for more than max_age days are pruned from the remote cache (local entries are pruned by git
+    rerere gc).
+    """
+    def __init__(self, local_dir, backend, max_age=DEFAULT_MAX_AGE_DAYS, logger=None):
+        """
+        :param local_dir: Local rr-cache directory.
+        :param backend: RRCacheBackend object.
+        :param max_age: Prune remote entries unused for more than given days, 0 to disable pruning.
+        :param logger: Logger object.
+        """
+        self.logger = logger or logging.getLogger(__name__)
+        self.local_dir = local_dir
+        self.backend = backend
+        self.max_age = max_age
+
+    def _entry(self, rr_id):
+        """
+        :return: Dict with hash and last used time of a local entry. thisimage is a leftover of an unresolved conflict,
+        so it is not part of the entry.
+        """
+        path = os.path.join(self.local_dir, rr_id)
+        digest = hashlib.sha1()
+        mtime = 0
+        for name in sorted(os.listdir(path)):
+            if name == 'thisimage' or not os.path.isfile(os.path.join(path, name)):
+                continue
+            with open(os.path.join(path, name), 'rb') as fobj:
+                digest.update(name + '\0' + fobj.read() + '\0')
+            mtime = max(mtime, os.path.getmtime(os.path.join(path, name)))
+
+        return {"hash": digest.hexdigest(), "time": int(mtime)}
+
+    def local_manifest(self):
+        """
+        :return: Dict of conflict ID -> entry of the local cache. Entries without a resolution are skipped.
+        """
+        entries = {}
+        if not os.path.exists(self.local_dir):
+            return entries
+
+        for rr_id in os.listdir(self.local_dir):
+            path = os.path.join(self.local_dir, rr_id)
+            if not os.path.isdir(path) or not any([name.startswith('postimage') for name in os.listdir(path)]):
+                continue
+            entries[rr_id] = self._entry(rr_id)
+
+        return entries
+
+    def _newer(self, src, dst):
+        """
+        :return: IDs of src entries missing in dst, or different and not older than the dst entry.
+        """
+        return [rr_id for rr_id, entry in src.items()
+                if rr_id not in dst or (dst[rr_id]["hash"] != entry["hash"] and entry["time"] >= dst[rr_id]["time"])]
+
+    def pull(self):
+        """
+        Download remote entries which are missing in the local cache, or changed more recently than the local ones.
+        :return: Number of downloaded entries.
+        """
+        start = time.time()
+        remote = self.backend.read_manifest().get("entries", {})
+        local = self.local_manifest()
+        ids = self._newer(remote, local)
+
+        if not os.path.exists(self.local_dir):
+            os.makedirs(self.local_dir)
+        if len(ids) > 0:
+            self.backend.download(ids, self.local_dir)
+
+        self.logger.info("rr-cache: downloaded %d of %d entries in %.2fs" % (len(ids), len(remote), time.time() - start))
+
+        return len(ids)
+
+    def push(self):
+        """
+        Upload local entries which are missing in the remote cache, or changed more recently than the remote ones, prune
+        old remote entries and update the remote manifest. Push is aborted if the remote manifest can not be read,
+        and the changes are merged with the latest remote manifest just before it is written, so entries pushed by
+        other runs in the meantime are kept.
+        :return: Number of uploaded entries.
+        """
+        start = time.time()
+        remote = self.backend.read_manifest().get("entries", {})
+        local = self.local_manifest()
+        ids = self._newer(local, remote)
+
+        if len(ids) > 0:
+            self.backend.upload(ids, self.local_dir)
+
+        for rr_id in ids:
+            remote[rr_id] = local[rr_id]
+        for rr_id, entry in local.items():
+            if remote[rr_id]["hash"] == entry["hash"]:
+                remote[rr_id]["time"] = max(entry["time"], remote[rr_id]["time"])
+
+        expired = []
+        if self.max_age > 0:
+            limit = time.time() - self.max_age * 24 * 3600
+            expired = [rr_id for rr_id, entry in remote.items() if entry["time"] < limit]
+            if len(expired) > 0:
+                self.backend.delete(expired)
+            for rr_id in expired:
+                del remote[rr_id]
+
+        latest = self.backend.read_manifest().get("entries", {})
+        for rr_id, entry in remote.items():
+            if rr_id not in latest or latest[rr_id]["time"] <= entry["time"]:
+                latest[rr_id] = entry
+        # Pruned entries are dropped even if they were used again in the meantime, their files are deleted. A run
+        # which still has them uploads them again.
+        for rr_id in expired:
+            latest.pop(rr_id, None)
+
+        self.backend.write_manifest({"version": 1, "entries": latest})
+
+        self.logger.info("rr-cache: uploaded %d, pruned %d, %d entries in remote cache, %.2fs" %
+                         (len(ids), len(expired), len(latest), time.time() - start))
+
+        return len(ids)
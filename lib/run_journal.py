@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+#
+# Persistent journal of completed integration steps
+#
+# Copyright (C) 2018 Sathya Kuppuswamy
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# @Author  : Sathya Kupppuswamy(sathyaosid@gmail.com)
+# @History :
+#            @v0.0 - Basic class support
+# @TODO    :
+#
+#
+
+import os
+import json
+import time
+import logging
+import threading
+
+class RunJournal(object):
+    """
+    Journal of the steps (fetch, merge, test, upload) completed by an integration run. Each step is recorded with its
+    inputs and result as soon as it is done, and the file is replaced atomically, so a crashed or failed run can be
+    resumed. A recorded step is only reused if its inputs (SHA IDs it was run on) did not change.
+    """
+    def __init__(self, path, resume=False, persist=True, logger=None):
+        """
+        :param path: Journal file path.
+        :param resume: Set True to keep the steps of the previous run, otherwise the journal is cleared.
+        :param persist: Set False to keep the journal in memory only, the journal file is neither read nor written.
+        :param logger: Logger object.
+        """
+        self.logger = logger or logging.getLogger(__name__)
+        self.path = path
+        self.steps = {}
+        self.reused = []
+        self.persist = persist
+        self._lock = threading.Lock()
+
+        if resume is True:
+            self._load()
+            self.logger.info("Resuming run, %d steps in journal %s" % (len(self.steps), self.path))
+        else:
+            self._save()
+
+    def _load(self):
+        if self.persist is False or not os.path.exists(self.path):
+            return
+
+        try:
+            with open(self.path) as fobj:
+                self.steps = json.load(fobj)
+        except ValueError:
+            self.logger.warn("Ignoring invalid run journal %s" % self.path)
+            self.steps = {}
+
+    def _save(self):
+        if self.persist is False:
+            return
+
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w+') as fobj:
+            json.dump(self.steps, fobj, indent=4, sort_keys=True)
+            fobj.flush()
+            os.fsync(fobj.fileno())
+        os.rename(tmp_path, self.path)
+
+    def get(self, step, inputs):
+        """
+        Get the result of a completed step.
+        :param step: Step name.
+        :param inputs: Inputs of the step, compared with the recorded ones.
+        :return: Recorded result, None if the step is not done or was done with different inputs.
+        """
+        with self._lock:
+            entry = self.steps.get(step, None)
+            if entry is None or entry['inputs'] != json.loads(json.dumps(inputs)):
+                return None
+            if entry['result'] is not False:
+                self.reused.append(step)
+            return entry['result']
+
+    def record(self, step, inputs, result):
+        """
+        Record a completed step.
+        :param step: Step name.
+        :param inputs: Inputs of the step (JSON serializable).
+        :param result: Result of the step (JSON serializable).
+        :return: None
+        """
+        with self._lock:
+            self.steps[step] = {'inputs': inputs, 'result': result, 'time': time.time()}
+            self._save()